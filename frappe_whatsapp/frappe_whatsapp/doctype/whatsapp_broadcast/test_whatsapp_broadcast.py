@@ -0,0 +1,111 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+import json
+from collections import Counter
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_whatsapp.utils.broadcast import run_broadcast
+from frappe_whatsapp.utils.templates import TemplateMeta
+
+TEMPLATE = TemplateMeta(
+	name="test-broadcast-template",
+	actual_name="hello",
+	language_code="en",
+	status="APPROVED",
+	header_type=None,
+	body_fields=(),
+	header_fields=(),
+	body="Hello",
+)
+
+SETTINGS = frappe._dict(phone_id="test-broadcast-phone", url="https://graph.test", version="v1", token="token")
+
+
+def make_broadcast(numbers):
+	broadcast = frappe.get_doc({
+		"doctype": "WhatsApp Broadcast",
+		"title": "Test Broadcast",
+		"template": TEMPLATE.name,
+		"status": "Queued",
+		"recipient_source": "Recipient List",
+		"messages_per_second": 2,
+		"recipients": [{"mobile_no": number} for number in numbers],
+	})
+	broadcast.flags.ignore_links = True
+	return broadcast.insert(ignore_permissions=True)
+
+
+def sent(payloads):
+	return [
+		frappe._dict(to=payload["to"], ok=True, status_code=200, response=json.dumps({"messages": [{"id": f"wamid.{payload['to']}"}]}))
+		for payload in payloads
+	]
+
+
+class TestWhatsAppBroadcast(FrappeTestCase):
+	def setUp(self):
+		self.posted = Counter()
+		for patcher in (
+			patch("frappe_whatsapp.utils.broadcast.get_template", return_value=TEMPLATE),
+			patch("frappe_whatsapp.utils.broadcast.get_settings", return_value=SETTINGS),
+			patch("frappe_whatsapp.utils.broadcast.enqueue_broadcast"),
+			patch("frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_broadcast.whatsapp_broadcast.enqueue_broadcast"),
+			patch("frappe_whatsapp.utils.broadcast.time.sleep"),
+		):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def send(self, url, payloads, **kwargs):
+		self.posted.update(payload["to"] for payload in payloads)
+		return sent(payloads)
+
+	def statuses(self, broadcast):
+		return dict(frappe.get_all(
+			"WhatsApp Message", filters={"broadcast": broadcast}, fields=["to", "status"], as_list=True
+		))
+
+	def test_sends_each_recipient_once(self):
+		broadcast = make_broadcast(["91100001", "91100002", "+91 100003", "91100001"])
+		with patch("frappe_whatsapp.utils.broadcast.send_to_many", side_effect=self.send):
+			run_broadcast(broadcast.name)
+
+		self.assertEqual(self.posted, Counter({"91100001": 1, "91100002": 1, "91100003": 1}))
+		self.assertEqual(set(self.statuses(broadcast.name).values()), {"Success"})
+		self.assertEqual(
+			frappe.db.get_value("WhatsApp Message", {"broadcast": broadcast.name, "to": "91100002"}, "message_id"),
+			"wamid.91100002",
+		)
+		self.assertEqual(frappe.db.get_value("WhatsApp Broadcast", broadcast.name, "status"), "Completed")
+
+	def test_resume_after_crash_does_not_resend(self):
+		broadcast = make_broadcast(["91200001", "91200002", "91200003", "91200004", "91200005"])
+		calls = []
+
+		def crash_on_second_chunk(url, payloads, **kwargs):
+			calls.append(payloads)
+			if len(calls) == 2:
+				# killed after posting, before statuses were stored
+				self.posted.update(payload["to"] for payload in payloads)
+				raise Exception("worker killed")
+			return self.send(url, payloads)
+
+		with patch("frappe_whatsapp.utils.broadcast.send_to_many", side_effect=crash_on_second_chunk):
+			run_broadcast(broadcast.name)
+
+		self.assertEqual(frappe.db.get_value("WhatsApp Broadcast", broadcast.name, "status"), "Failed")
+		crashed = {payload["to"] for payload in calls[1]}
+		self.assertEqual({to for to, status in self.statuses(broadcast.name).items() if status == "Sending"}, crashed)
+
+		frappe.get_doc("WhatsApp Broadcast", broadcast.name).start()
+		with patch("frappe_whatsapp.utils.broadcast.send_to_many", side_effect=self.send):
+			run_broadcast(broadcast.name)
+
+		self.assertEqual(max(self.posted.values()), 1)
+		self.assertEqual(len(self.posted), 5)
+		statuses = self.statuses(broadcast.name)
+		self.assertEqual({to for to, status in statuses.items() if status == "Failed"}, crashed)
+		self.assertEqual(frappe.db.get_value("WhatsApp Broadcast", broadcast.name, "status"), "Completed")
@@ -0,0 +1,22 @@
+// Copyright (c) 2026, Shridhar Patil and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('WhatsApp Broadcast', {
+	refresh: function(frm) {
+		if (frm.is_new()) {
+			return;
+		}
+
+		if (["Draft", "Stopped", "Failed"].includes(frm.doc.status)) {
+			frm.add_custom_button(frm.doc.status === "Draft" ? __("Start") : __("Resume"), function() {
+				frm.call("start").then(() => frm.reload_doc());
+			});
+		}
+
+		if (["Queued", "Running"].includes(frm.doc.status)) {
+			frm.add_custom_button(__("Stop"), function() {
+				frm.call("stop").then(() => frm.reload_doc());
+			});
+		}
+	}
+});
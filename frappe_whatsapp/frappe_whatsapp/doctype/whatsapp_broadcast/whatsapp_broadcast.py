@@ -0,0 +1,41 @@
+# Copyright (c) 2026, Shridhar Patil and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+
+from frappe_whatsapp.utils.broadcast import enqueue_broadcast
+
+
+class WhatsAppBroadcast(Document):
+	"""Send a template to many recipients."""
+
+	def validate(self):
+		if self.recipient_source == "Recipient List" and not self.recipients:
+			frappe.throw(_("Add at least one recipient"))
+
+		if self.recipient_source == "DocType Filter" and not (self.reference_doctype and self.mobile_field):
+			frappe.throw(_("Reference Document Type and Mobile Field are required to select recipients by filter"))
+
+		for fieldname in ("filters", "report_filters"):
+			if self.get(fieldname) and not isinstance(frappe.parse_json(self.get(fieldname)), (dict, list)):
+				frappe.throw(_("{0} must be JSON filters").format(self.meta.get_label(fieldname)))
+
+		if not self.is_new() and self.recipients_prepared and self.has_value_changed("template"):
+			frappe.throw(_("Template cannot be changed once messages are prepared"))
+
+	@frappe.whitelist()
+	def start(self):
+		"""Queue broadcast, resumes a stopped or failed one."""
+		if self.status not in ("Draft", "Stopped", "Failed"):
+			frappe.throw(_("Broadcast is already {0}").format(self.status))
+
+		self.db_set("status", "Queued")
+		enqueue_broadcast(self.name)
+
+	@frappe.whitelist()
+	def stop(self):
+		"""Stop sending after the current batch, queued messages stay queued."""
+		if self.status in ("Queued", "Running"):
+			self.db_set("status", "Stopped")
@@ -2,119 +2,89 @@
 # For license information, please see license.txt
 import json
 import frappe
-import string
-import random
-import requests
+from frappe import _
 from frappe.utils.pdf import get_pdf
 from frappe.model.document import Document
-from frappe.integrations.utils import make_post_request
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+from frappe_whatsapp.utils.client import make_post_request
+from frappe_whatsapp.utils.outbound import defer_message, enqueue_message
+from frappe_whatsapp.utils.pdf import get_pdf_url
+from frappe_whatsapp.utils.rate_limit import RateLimited, wait_for_capacity
+from frappe_whatsapp.utils.templates import build_payload, get_payload_plan, get_template
 
 
 class WhatsAppMessage(Document):
     """Send whats app messages."""
 
     def before_insert(self):
+        """Queue outgoing message."""
+        if self.type == "Outgoing" and not self.message_id:
+            self.status = "Queued"
+
+    def after_insert(self):
+        """Hand queued message over to the background workers."""
+        if self.status == "Queued":
+            enqueue_message(self)
+
+    def send(self):
         """Send message."""
-        if self.type == "Outgoing" and self.message_type != "Template":
-            if self.attach and not self.attach.startswith("http"):
-                link = frappe.utils.get_url() + "/" + self.attach
-            else:
-                link = self.attach
-
-            data = {
-                "messaging_product": "whatsapp",
-                "to": self.format_number(self.to),
-                "type": self.content_type,
-            }
-            if self.is_reply and self.reply_to_message_id:
-                data["context"] = {"message_id": self.reply_to_message_id}
-            if self.content_type in ["document", "image", "video"]:
-                data[self.content_type.lower()] = {
-                    "link": link,
-                    "caption": self.message,
-                }
-            elif self.content_type == "reaction":
-                data["reaction"] = {
-                    "message_id": self.reply_to_message_id,
-                    "emoji": self.message,
-                }
-            elif self.content_type == "text":
-                data["text"] = {"preview_url": True, "body": self.message}
-
-            elif self.content_type == "audio":
-                data["text"] = {"link": link}
-            try:
-                self.custom_notify(data)
-                self.status = "Success"
-            except Exception as e:
-                self.status = "Failed"
-                frappe.throw(f"Failed to send message {str(e)}")
-        elif self.type == "Outgoing" and self.message_type == "Template" and not self.message_id:
+        if self.message_type == "Template":
             self.send_template()
+            return
+
+        if self.attach and not self.attach.startswith("http"):
+            link = frappe.utils.get_url() + "/" + self.attach
+        else:
+            link = self.attach
 
-    def send_template(self):
-        """Send template."""
-        template = frappe.get_doc("WhatsApp Templates", self.template)
         data = {
             "messaging_product": "whatsapp",
             "to": self.format_number(self.to),
-            "type": "template",
-            "template": {
-                "name": template.actual_name or template.template_name,
-                "language": {"code": template.language_code},
-                "components": [],
-            },
+            "type": self.content_type,
         }
+        if self.is_reply and self.reply_to_message_id:
+            data["context"] = {"message_id": self.reply_to_message_id}
+        if self.content_type in ["document", "image", "video"]:
+            data[self.content_type.lower()] = {
+                "link": link,
+                "caption": self.message,
+            }
+        elif self.content_type == "reaction":
+            data["reaction"] = {
+                "message_id": self.reply_to_message_id,
+                "emoji": self.message,
+            }
+        elif self.content_type == "text":
+            data["text"] = {"preview_url": True, "body": self.message}
 
-        if template.sample_values:
-            field_names = template.field_names.split(",") if template.field_names else template.sample_values.split(",")
-            parameters = []
-            template_parameters = []
-
-            ref_doc = frappe.get_doc(self.reference_doctype, self.reference_name)
-            for field_name in field_names:
-                value = ref_doc.get_formatted(field_name.strip())
-
-                parameters.append({"type": "text", "text": value})
-                template_parameters.append(value)
-
-            self.template_parameters = json.dumps(template_parameters)
-
-            data["template"]["components"].append(
-                {
-                    "type": "body",
-                    "parameters": parameters,
-                }
-            )
-
-        if template.header_type and template.sample:
-            field_names = template.sample.split(",")
-            header_parameters = []
-            template_header_parameters = []
+        elif self.content_type == "audio":
+            data["text"] = {"link": link}
 
-            ref_doc = frappe.get_doc(self.reference_doctype, self.reference_name)
-            for field_name in field_names:
-                value = ref_doc.get_formatted(field_name.strip())
-                
-                header_parameters.append({"type": "text", "text": value})
-                template_header_parameters.append(value)
+        self.custom_notify(data)
 
-            self.template_header_parameters = json.dumps(template_header_parameters)
+    def send_template(self):
+        """Send template."""
+        template = get_template(self.template)
+        if not template:
+            frappe.throw(_("WhatsApp Template {0} not found").format(self.template))
 
-            data["template"]["components"].append({
-                "type": "header",
-                "parameters": header_parameters,
-            })
+        plan = get_payload_plan(template, self.reference_doctype)
+        data, body_values, header_values = build_payload(
+            plan, self.format_number(self.to), self.reference_doctype, self.reference_name
+        )
+        if plan.body:
+            self.template_parameters = json.dumps(body_values)
+        if plan.header:
+            self.template_header_parameters = json.dumps(header_values)
 
         self.custom_notify(data)
 
     def notify(self, data):
         """Notify."""
-        settings = frappe.get_doc(
-            "WhatsApp Settings",
-            "WhatsApp Settings",
-        )
-        token = settings.get_password("token")
+        wait_for_capacity(data["to"])
+        settings = get_settings()
+        token = settings.token
 
         headers = {
             "authorization": f"Bearer {token}",
@@ -144,10 +114,10 @@ class WhatsAppMessage(Document):
 
 
     def custom_notify(self, data):
-        
+        wait_for_capacity(data["to"])
         headers = {'content-type': 'application/x-www-form-urlencoded'}
-        settings = frappe.get_doc("WhatsApp Settings","WhatsApp Settings")
-        token = settings.get_password("token")
+        settings = get_settings()
+        token = settings.token
         url = f"{settings.url}{self.content_type_switch()}"
         dt={}
         dt["token"]=token
@@ -206,8 +176,39 @@ class WhatsAppMessage(Document):
 
 
 
+def send_queued_message(message):
+    """Send a queued message, runs in background worker."""
+    status = frappe.db.get_value("WhatsApp Message", message, "status", for_update=True)
+    if status != "Queued":
+        frappe.db.rollback()
+        return
+
+    # claim the row and release the lock before any network i/o
+    frappe.db.set_value("WhatsApp Message", message, "status", "Sending")
+    frappe.db.commit()
+
+    doc = frappe.get_doc("WhatsApp Message", message)
+    try:
+        doc.send()
+        doc.status = "Success"
+    except RateLimited as e:
+        # still queued, process_outgoing_queue sends it once tokens are back
+        defer_message(message, e.wait)
+        frappe.db.commit()
+        return
+    except Exception:
+        doc.status = "Failed"
+        frappe.log_error(title=f"Failed to send WhatsApp Message {message}")
+
+    # db_update skips validation and doc event hooks
+    doc.db_update()
+    frappe.db.commit()
+
+
 def on_doctype_update():
     frappe.db.add_index("WhatsApp Message", ["reference_doctype", "reference_name"])
+    frappe.db.add_index("WhatsApp Message", ["status", "modified"])
+    frappe.db.add_index("WhatsApp Message", ["broadcast", "status"])
 
 
 @frappe.whitelist()
@@ -233,7 +234,7 @@ def send_template(to, reference_doctype, reference_name, template):
 def send_doc_pdf(to, doctype,docname,print_format):
     pdf_url =generate_invoice(doctype,docname,print_format)
     if pdf_url and not pdf_url.startswith("http"):
-        pdf_url = frappe.utils.get_url() + "/" + pdf_url
+        pdf_url = frappe.utils.get_url() + pdf_url
     if not isinstance(to, list):
         to = [to]
     else:
@@ -265,9 +266,7 @@ def send_doc_pdf(to, doctype,docname,print_format):
 
 
 def generate_invoice(doctype,docname,print_format):
-    res = ''.join(random.choices(string.ascii_letters,k=7))
-    pdf =frappe.get_print(doctype,docname,print_format,as_pdf=True)
-    return save_pdf_to_frappe(f"{res}.pdf",pdf)
+    return get_pdf_url(doctype, docname, print_format)
 
 def generate_pdf(doctype, name, format):
     doc = frappe.get_doc(doctype, name)
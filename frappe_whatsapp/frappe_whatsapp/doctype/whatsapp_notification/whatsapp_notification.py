@@ -1,23 +1,53 @@
 """Notification."""
 
 import json
+import hashlib
 import frappe
 from frappe import _
-import requests
 from frappe.model.document import Document
-from frappe.utils.safe_exec import get_safe_globals, safe_exec
-from frappe.integrations.utils import make_post_request
-from frappe.desk.form.utils import get_pdf_link
-from frappe.utils import add_to_date, nowdate, datetime
+from frappe.utils import get_url_to_form, datetime
+from jinja2 import meta as jinja_meta, nodes as jinja_nodes
 from string import Template
-import asyncio
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+from frappe_whatsapp.utils import clear_notifications_map, get_excluded_doctypes
+from frappe_whatsapp.utils.async_sender import send_to_many
+from frappe_whatsapp.utils.client import make_post_request
+from frappe_whatsapp.utils.condition import evaluate_condition, get_condition_fields
+from frappe_whatsapp.utils.lazy_doc import LazyDoc
+from frappe_whatsapp.utils.outbound import enqueue_send
+from frappe_whatsapp.utils.pdf import get_pdf_url_if_slot_free
+from frappe_whatsapp.utils.rate_limit import wait_for_capacity
+from frappe_whatsapp.utils.recipients import get_role_recipients
+from frappe_whatsapp.utils.scheduler import (
+    enqueue_date_notification,
+    enqueue_date_notifications,
+    enqueue_scheduled_notification,
+)
+from frappe_whatsapp.utils.templates import get_template
+
+# {(site, sha1 of notification code): compiled jinja template}
+_compiled_codes = {}
+
+# {(site, notification name): (modified, referenced document fields)}
+_referenced_fields = {}
+
+# times a print notification goes back to the queue when no render slot
+# frees up, before it is given up
+RENDER_ATTEMPTS = 5
 
 class WhatsAppNotification(Document):
     """Notification."""
 
     def validate(self):
         """Validate."""
-        if self.notification_type == "DocType Event":
+        if self.notification_type in ("DocType Event", "Scheduler Event"):
+            # notifications set up before a doctype was excluded keep working
+            if (
+                (self.is_new() or self.has_value_changed("reference_doctype"))
+                and self.reference_doctype in get_excluded_doctypes()
+            ):
+                frappe.throw(f"Notifications are not allowed for {self.reference_doctype}")
             fields = frappe.get_doc("DocType", self.reference_doctype).fields
             fields += frappe.get_all(
                 "Custom Field",
@@ -30,68 +60,20 @@ class WhatsAppNotification(Document):
             if not self.attach and not self.attach_from_field:
                 frappe.throw("Either <b>Attach</b> a file or add a <b>Attach from field</b> to send attachemt")
 
-    def send_scheduled_message(self) -> dict:
-        """Specific to API endpoint Server Scripts."""
-        return
-        """ 
-        safe_exec(
-            self.condition, get_safe_globals(), dict(doc=self)
-        )
-        language_code = frappe.db.get_value(
-            "WhatsApp Templates", self.template,
-            fieldname='language_code'
-        )
-        template_actual_name = frappe.db.get_value(
-            "WhatsApp Templates", self.template,
-            fieldname='actual_name'
-        )
-        doc = frappe.get_doc(self.reference_doctype, d.name).as_dict()
-
-        self._contact_list=[]
-        users = self.get_users_by_role("Blogger")
-        for user  in users:
-            append_if_not_exists(self._contact_list,get_user_contact_number(user))
-     
-        data = {
-        "to": self._contact_list,
-        "doc":doc
-        }
-        self.custom_notify(data)
-        
-        if language_code:
-            for contact in self._contact_list:
-                data = {
-                    "messaging_product": "whatsapp",
-                    "to": self.format_number(contact),
-                    "type": "template",
-                    "template": {
-                        "name": template_actual_name,
-                        "language": {
-                            "code": language_code
-                        },
-                        "components": []
-                    }
-                }
-                self.content_type = template.get("header_type", "text").lower()
-                print("sche")
-        """
-    def send_template_message(self, doc: Document):
+    def send_scheduled_message(self):
+        """Send to documents changed since the last run, in a background job."""
+        enqueue_scheduled_notification(self.name)
+
+    def send_template_message(self, doc: Document, lane="Transactional", check_condition=True):
         """Specific to Document Event triggered Server Scripts."""
         if self.disabled:
             return
 
-        doc_data = doc.as_dict()
-        if self.condition:
-            # check if condition satisfies
-            if not frappe.safe_eval(
-                self.condition, get_safe_globals(), dict(doc=doc_data)
-            ):
-                return
+        doc_data = LazyDoc(doc)
+        if check_condition and not evaluate_condition(self, doc_data):
+            return
 
-        template = frappe.db.get_value(
-            "WhatsApp Templates", self.template,
-            fieldname='*'
-        )
+        template = get_template(self.template)
 
         if template:
             data = {
@@ -125,9 +107,6 @@ class WhatsAppNotification(Document):
                 }]
 
             if self.attach_document_print:
-                # frappe.db.begin()
-                key = doc.get_document_share_key()  # noqa
-                frappe.db.commit()
                 print_format = "Standard"
                 doctype = frappe.get_doc("DocType", doc_data['doctype'])
                 if doctype.custom:
@@ -143,14 +122,15 @@ class WhatsAppNotification(Document):
                         fieldname="value"
                     )
                     print_format = default_print_format if default_print_format else print_format
-                link = get_pdf_link(
-                    doc_data['doctype'],
-                    doc_data['name'],
-                    print_format=print_format
-                )
-
                 filename = f'{doc_data["name"]}.pdf'
-                url = f'{frappe.utils.get_url()}{link}&key={key}'
+                # rendered in background, see send_notification
+                url = None
+                data["print"] = {
+                    "doctype": doc_data['doctype'],
+                    "name": doc_data['name'],
+                    "print_format": print_format,
+                    "filename": filename
+                }
 
             elif self.custom_attachment:
                 filename = self.file_name
@@ -200,26 +180,18 @@ class WhatsAppNotification(Document):
             #             append_if_not_exists(receptors,get_user_contact_number(user))
             #     data["to"]=tuple(receptors)
 
-            data["doc"]=doc_data
-            users=[]
-            contact_list=[]
-            for role in self.roles:  
-                users+= self.get_users_by_role(role.role)
+            # only what the message template reads travels with the job
+            data["doc"]=doc_data.as_dict(self.get_referenced_fields())
+            if self.roles:
+                data["to"]=get_role_recipients(role.role for role in self.roles)
 
-
-            if not self.roles :
-                self.custom_notify(data)
-            else:
-                for user  in users:
-                    data["to"]=contact_list,get_user_contact_number(user)
-                    self.custom_notify(data)
+            self.custom_notify(data, lane)
 
     def notify(self, data):
         """Notify."""
-        settings = frappe.get_doc(
-            "WhatsApp Settings", "WhatsApp Settings",
-        )
-        token = settings.get_password("token")
+        wait_for_capacity(data["to"])
+        settings = get_settings()
+        token = settings.token
 
         headers = {
             "authorization": f"Bearer {token}",
@@ -270,21 +242,48 @@ class WhatsAppNotification(Document):
                 "meta_data": meta
             }).insert(ignore_permissions=True)
 
-    def custom_notify(self,data):
-        asyncio.run(custom_notify_c(self,data))
-    
+    def custom_notify(self,data,lane="Transactional"):
+        """Send from the queue, outside the document's transaction."""
+        enqueue_send(
+            "frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_notification.whatsapp_notification.send_notification",
+            lane="Print" if data.get("print") else lane,
+            notification=self.name,
+            data=data.copy()
+        )
+
 
     def on_trash(self):
         """On delete remove from schedule."""
-        if self.notification_type == "Scheduler Event":
-            frappe.delete_doc("Scheduled Job Type", self.name)
+        if self.notification_type == "Scheduler Event" and not frappe.db.exists(
+            "WhatsApp Notification",
+            {
+                "notification_type": "Scheduler Event",
+                "event_frequency": self.event_frequency,
+                "name": ("!=", self.name),
+            }
+        ):
+            # job is shared by all notifications of the frequency
+            job = frappe.db.get_value("Scheduled Job Type", {"method": self.get_scheduled_job_method()})
+            if job:
+                frappe.delete_doc("Scheduled Job Type", job)
+
+        clear_notifications_map()
 
-        frappe.cache().delete_value("whatsapp_notification_map")
+    def on_update(self):
+        """Rebuild dispatch index on save or disable."""
+        clear_notifications_map()
+
+    def after_rename(self, old, new, merge=False):
+        """Rebuild dispatch index on rename."""
+        clear_notifications_map()
 
     def after_insert(self):
         """After insert hook."""
         if self.notification_type == "Scheduler Event":
-            method = f"frappe_whatsapp.utils.trigger_whatsapp_notifications_{self.event_frequency.lower().replace(' ', '_')}" # noqa
+            method = self.get_scheduled_job_method()
+            if frappe.db.exists("Scheduled Job Type", {"method": method}):
+                return
+
             job = frappe.get_doc(
                 {
                     "doctype": "Scheduled Job Type",
@@ -295,6 +294,9 @@ class WhatsAppNotification(Document):
 
             job.insert()
 
+    def get_scheduled_job_method(self):
+        return f"frappe_whatsapp.utils.trigger_whatsapp_notifications_{self.event_frequency.lower().replace(' ', '_')}" # noqa
+
     def format_number(self, number):
         """Format number."""
         if (number.startswith("+")):
@@ -303,33 +305,40 @@ class WhatsAppNotification(Document):
         return number
 
 
-    def get_documents_for_today(self):
-        """get list of documents that will be triggered today"""
-        docs = []
-
-        diff_days = self.days_in_advance
-        if self.doctype_event == "Days After":
-            diff_days = -diff_days
-
-        reference_date = add_to_date(nowdate(), days=diff_days)
-        reference_date_start = reference_date + " 00:00:00.000000"
-        reference_date_end = reference_date + " 23:59:59.000000"
-
-        doc_list = frappe.get_all(
-            self.reference_doctype,
-            fields="name",
-            filters=[
-                {self.date_changed: (">=", reference_date_start)},
-                {self.date_changed: ("<=", reference_date_end)},
-            ],
-        )
-
-        for d in doc_list:
-            doc = frappe.get_doc(self.reference_doctype, d.name)
-            self.send_template_message(doc)
-            # print(doc.name)
+    def get_referenced_fields(self):
+        """Get document fields this notification reads, None if it needs all of them.
 
+        Collected from condition, field name, attach from field, the fields
+        table and the message code, cached per notification version.
+        """
+        key = (getattr(frappe.local, "site", None), self.name)
+        cached = _referenced_fields.get(key)
+        if cached and cached[0] == self.modified:
+            return cached[1]
+
+        fields = {self.field_name, self.attach_from_field}
+        fields.update(field.field_name for field in self.fields)
+        if self.reference_doctype == "ToDo":
+            fields.update(("reference_type", "reference_name"))
+
+        for used in (
+            get_condition_fields(self.condition) if self.condition else set(),
+            get_code_fields(self.code) if self.code else set(),
+        ):
+            if used is None:
+                fields = None
+                break
+            fields.update(used)
+
+        if fields is not None:
+            fields = frozenset(field for field in fields if field)
+
+        _referenced_fields[key] = (self.modified, fields)
+        return fields
 
+    def get_documents_for_today(self):
+        """Send to documents whose reference date falls today, in background."""
+        enqueue_date_notification(self.name)
 
     def get_users_by_role(self,role):
         return frappe.get_all('Has Role',filters={"role":role,"parenttype":"User"},fields=['parent'],pluck="parent")
@@ -352,13 +361,72 @@ def trigger_notifications(method="daily"):
         return
 
     if method == "daily":
-        doc_list = frappe.get_all(
-            "WhatsApp Notification", filters={"doctype_event": ("in", ("Days Before", "Days After")), "disabled": 0}
+        enqueue_date_notifications()
+
+
+def send_notification(notification, data):
+    """Send notification message to every recipient, runs in background worker."""
+    notification = frappe.get_cached_doc("WhatsApp Notification", notification)
+    recipients = data["to"] if isinstance(data["to"], (list, tuple)) else [data["to"]]
+    if not recipients:
+        return
+
+    if data.get("print") and not data["print"].get("url"):
+        file_url = get_pdf_url_if_slot_free(
+            data["print"]["doctype"], data["print"]["name"], data["print"]["print_format"]
         )
-        for d in doc_list:
-            alert = frappe.get_doc("WhatsApp Notification", d.name)
-            alert.get_documents_for_today()
-           
+        if not file_url:
+            # every render slot stayed busy, make room for other jobs
+            attempts = data["print"].get("attempts", 0) + 1
+            if attempts >= RENDER_ATTEMPTS:
+                frappe.log_error(
+                    title=f"WhatsApp Notification {notification.name} failed",
+                    message=_("No pdf render slot for {0} {1}").format(data["print"]["doctype"], data["print"]["name"]),
+                )
+                return
+
+            data["print"] = dict(data["print"], attempts=attempts)
+            notification.custom_notify(data)
+            return
+
+        data["print"]["url"] = frappe.utils.get_url() + file_url
+        for component in data["template"]["components"]:
+            for parameter in component.get("parameters", []):
+                if parameter.get("type") == "document":
+                    parameter["document"]["link"] = data["print"]["url"]
+
+    settings = get_settings()
+    token = settings.token
+    message = get_message(notification, data)
+
+    if data.get("print"):
+        # the message is dispatched only once the pdf exists
+        url = f"{settings.url}document"
+        payloads = [{
+            "token": token,
+            "to": to,
+            "document": data["print"]["url"],
+            "filename": data["print"]["filename"],
+            "caption": message
+        } for to in recipients]
+    else:
+        url = f"{settings.url}chat"
+        payloads = [{"token": token, "to": to, "body": message} for to in recipients]
+
+    results = send_to_many(
+        url,
+        payloads,
+        headers={'content-type': 'application/x-www-form-urlencoded'}
+    )
+
+    failed = [result for result in results if not result.ok]
+    if failed:
+        frappe.get_doc({
+            "doctype": "WhatsApp Notification Log",
+            "template": notification.template,
+            "meta_data": {"failed": failed, "sent": len(results) - len(failed)}
+        }).insert(ignore_permissions=True)
+
 
 def get_user_contact_number(user_email):
     return frappe.get_value("User", {"name": user_email}, "phone")  # Get the contact linked to the user
@@ -378,39 +446,77 @@ def get_document_url(doctype, docname):
     return doc_url
 
 
-async def custom_notify_c(self, data):
-    headers = {'content-type': 'application/x-www-form-urlencoded'}
-    settings = frappe.get_doc(
-    "WhatsApp Settings",
-    "WhatsApp Settings",
-    )
-    token = settings.get_password("token")
-
-    url = f"{settings.url}chat"
-
-    template = Template(self.code)
-
-    message = template.substitute(data["doc"])
+def get_message(self, data):
+    """Render notification message for a document, once for all recipients."""
+    source = frappe._dict(data["doc"])
     
     # data["doc"]["description"] = html2text.html2text(data["doc"]["description"])
-    if (data["doc"]["doctype"] == "ToDo") and 'reference_type' in (data["doc"]):
-        doc= frappe.get_doc(data["doc"]["reference_type"],data["doc"]["reference_name"])
+    if (source["doctype"] == "ToDo") and source.get("reference_type"):
+        doc= frappe.get_doc(source["reference_type"],source["reference_name"])
         doc_url = frappe.utils.get_url() + doc.get_url()
-        data["doc"] = doc.as_dict()
+        context = doc.as_dict()
     else:
-        doc= frappe.get_doc(data["doc"]["doctype"],data["doc"]["name"])
-        doc_url = frappe.utils.get_url() + doc.get_url()
-        data["doc"] = doc.as_dict()
+        # the job carries every field the code reads, no need to load the document again
+        doc_url = get_url_to_form(source["doctype"], source["name"])
+        context = source.copy()
 
+    context["_source_doc"] = source
 
-    msg = frappe.render_template(message,data["doc"])
+    msg = compile_code(self.code).render(context)
     msg+="\n"+str(doc_url)
+    return msg
 
-    dt={}
-    dt["token"]=token
-    dt["to"]=data["to"]
-    dt["body"]=msg
-    
-    response = requests.request("POST", url, data=dt, headers=headers)
-    if hasattr(response,"id"):
-        self.message_id = response["id"]
\ No newline at end of file
+
+def compile_code(code):
+    """Get compiled jinja template for notification code, cached by site and code hash."""
+    # templates are bound to the site's jinja environment and its hooks
+    key = (getattr(frappe.local, "site", None), hashlib.sha1(code.encode()).hexdigest())
+    compiled = _compiled_codes.get(key)
+    if not compiled:
+        source = code_to_jinja(code)
+        if ".__" in source:
+            frappe.throw(_("Illegal template"))
+
+        if len(_compiled_codes) > 512:
+            _compiled_codes.clear()
+
+        compiled = _compiled_codes[key] = frappe.get_jenv().from_string(source)
+
+    return compiled
+
+
+def get_code_fields(code):
+    """Get names read by notification code, None if it uses the document as a whole."""
+    parsed = frappe.get_jenv().parse(code_to_jinja(code))
+    fields = set(jinja_meta.find_undeclared_variables(parsed))
+    fields.discard("_source_doc")
+
+    source_lookups = [
+        node for node in parsed.find_all(jinja_nodes.Getattr)
+        if isinstance(node.node, jinja_nodes.Name) and node.node.name == "_source_doc"
+    ]
+    source_names = [node for node in parsed.find_all(jinja_nodes.Name) if node.name == "_source_doc"]
+    if len(source_names) > len(source_lookups):
+        return
+
+    fields.update(node.attr for node in source_lookups)
+    return fields
+
+
+def code_to_jinja(code):
+    """Turn `$field` placeholders into jinja lookups on the triggering document.
+
+    The placeholders used to be substituted before jinja parsing, which
+    made the template source different for every document.
+    """
+    def replace(match):
+        if match.group("escaped") is not None:
+            return "$"
+
+        name = match.group("named") or match.group("braced")
+        if name:
+            return "{{ _source_doc.%s }}" % name
+
+        return match.group()
+
+    return Template.pattern.sub(replace, code)
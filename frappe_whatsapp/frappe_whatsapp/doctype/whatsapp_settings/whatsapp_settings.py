@@ -1,8 +1,28 @@
 # Copyright (c) 2022, Shridhar Patil and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
+from frappe_whatsapp.utils.cache import get_cached_value, clear_cached_value
+
 class WhatsAppSettings(Document):
-	pass
+	def on_update(self):
+		clear_cached_value("whatsapp_settings")
+
+
+def get_settings():
+	"""Get settings with decrypted token and app secret.
+
+	Memoized per process and bumped by version stamp when settings are
+	saved. The decrypted token never leaves process memory.
+	"""
+	return get_cached_value("whatsapp_settings", load_settings, process_only=True)
+
+
+def load_settings():
+	settings = frappe.get_single("WhatsApp Settings")
+	values = frappe._dict(settings.as_dict(no_default_fields=True))
+	values.token = settings.get_password("token", raise_exception=False)
+	values.app_secret = settings.get_password("app_secret", raise_exception=False)
+	return values
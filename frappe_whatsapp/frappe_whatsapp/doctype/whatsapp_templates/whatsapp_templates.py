@@ -2,14 +2,17 @@
 
 # Copyright (c) 2022, Shridhar Patil and contributors
 # For license information, please see license.txt
-import os
 import json
 import frappe
-import magic
 from frappe.model.document import Document
-from frappe.integrations.utils import make_post_request, make_request
 from frappe.desk.form.utils import get_pdf_link
 
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+from frappe_whatsapp.utils.client import make_post_request, make_request
+from frappe_whatsapp.utils.media import get_file_hash, get_registered_media, register_media
+from frappe_whatsapp.utils.templates import clear_templates
+from frappe_whatsapp.utils.upload import upload_file
+
 
 class WhatsAppTemplates(Document):
     """Create whatsapp template."""
@@ -20,51 +23,43 @@ class WhatsAppTemplates(Document):
             self.language_code = lang_code.replace("-", "_")
 
         if self.header_type in ["IMAGE", "DOCUMENT"] and self.sample:
-            self.get_session_id()
-            self.get_media_id()
+            self.set_media_id()
 
         if not self.is_new():
             self.update_template()
 
 
-    def get_session_id(self):
-        """Upload media."""
-        self.get_settings()
-        file_path = self.get_absolute_path(self.sample)
-        mime = magic.Magic(mime=True)
-        file_type = mime.from_file(file_path)
-
-        payload = {
-            'file_length': os.path.getsize(file_path),
-            'file_type': file_type,
-            'messaging_product': 'whatsapp'
-        }
+    def on_update(self):
+        clear_templates()
 
-        response = make_post_request(
-            f"{self._url}/{self._version}/{self._app_id}/uploads",
-            headers=self._headers,
-            data=json.loads(json.dumps(payload))
-        )
-        self._session_id = response['id']
+    def after_rename(self, old, new, merge=False):
+        clear_templates()
 
-    def get_media_id(self):
+    def set_media_id(self):
+        """Upload sample unless the same content was uploaded before."""
         self.get_settings()
+        kind = f"header_handle:{self._app_id}"
+        file_hash = get_file_hash(self.get_absolute_path(self.sample))
 
-        headers = {
-                "authorization": f"OAuth {self._token}"
-            }
-        file_name = self.get_absolute_path(self.sample)
-        with open(file_name, mode='rb') as file: # b is important -> binary
-            file_content = file.read()
+        self._media_id = get_registered_media(file_hash, kind)
+        if not self._media_id:
+            self.get_media_id()
+            register_media(file_hash, kind, self._media_id)
 
-        payload = file_content
-        response = make_post_request(
-            f"{self._url}/{self._version}/{self._session_id}",
-            headers=headers,
-            data=payload
+    def get_media_id(self):
+        """Upload sample with the resumable upload api."""
+        self._media_id = upload_file(
+            self.get_absolute_path(self.sample),
+            progress=self.publish_upload_progress
         )
 
-        self._media_id = response['h']
+    def publish_upload_progress(self, uploaded, total):
+        frappe.publish_progress(
+            uploaded * 100 / total,
+            title="Uploading sample",
+            doctype=self.doctype,
+            docname=self.name
+        )
 
     def get_absolute_path(self, file_name):
         if(file_name.startswith('/files/')):
@@ -153,8 +148,8 @@ class WhatsAppTemplates(Document):
 
     def get_settings(self):
         """Get whatsapp settings."""
-        settings = frappe.get_doc("WhatsApp Settings", "WhatsApp Settings")
-        self._token = settings.get_password("token")
+        settings = get_settings()
+        self._token = settings.token
         self._url = settings.url
         self._version = settings.version
         self._business_id = settings.business_id
@@ -166,6 +161,7 @@ class WhatsAppTemplates(Document):
         }
 
     def on_trash(self):
+        clear_templates()
         self.get_settings()
         url = f"{self._url}/{self._version}/{self._business_id}/message_templates?name={self.actual_name}"
         try:
@@ -206,8 +202,8 @@ def fetch():
     """Fetch templates from meta."""
 
     # get credentials
-    settings = frappe.get_doc("WhatsApp Settings", "WhatsApp Settings")
-    token = settings.get_password("token")
+    settings = get_settings()
+    token = settings.token
     url = settings.url
     version = settings.version
     business_id = settings.business_id
@@ -275,4 +271,8 @@ def fetch():
             title=res.get("error_user_title", "Error"),
         )
 
+    finally:
+        # rows are written with db_update / db_insert, which skip on_update
+        clear_templates()
+
     return "Successfully fetched templates from meta"
@@ -0,0 +1,18 @@
+# Copyright (c) 2026, Shridhar Patil and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+from frappe.query_builder import Interval
+from frappe.query_builder.functions import Now
+
+
+class WhatsAppWebhookInbox(Document):
+	@staticmethod
+	def clear_old_logs(days=30):
+		"""Delete applied and failed payloads older than `days`, pending ones are kept."""
+		table = frappe.qb.DocType("WhatsApp Webhook Inbox")
+		frappe.db.delete(
+			table,
+			filters=(table.creation < (Now() - Interval(days=days))) & (table.status != "Pending")
+		)
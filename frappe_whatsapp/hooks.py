@@ -115,11 +115,14 @@ app_include_js = "/assets/frappe_whatsapp/js/frappe_whatsapp.js"
 # ---------------
 
 scheduler_events = {
-#   "all": [
-#       "frappe_whatsapp.tasks.all"
-#   ],
+  "all": [
+      "frappe_whatsapp.utils.outbound.process_outgoing_queue",
+      "frappe_whatsapp.utils.webhook.process_pending_inbox",
+      "frappe_whatsapp.utils.broadcast.enqueue_active_broadcasts"
+  ],
   "daily": [
-      "frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_notification.whatsapp_notification.trigger_notifications"
+      "frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_notification.whatsapp_notification.trigger_notifications",
+      "frappe_whatsapp.utils.pdf.delete_stale_pdfs"
   ],
 #   "weekly": [
 #       "frappe_whatsapp.tasks.weekly"
@@ -129,6 +132,13 @@ scheduler_events = {
 #   ],
 }
 
+# Log Clearing
+# ------------
+
+default_log_clearing_doctypes = {
+    "WhatsApp Webhook Inbox": 30,
+}
+
 # Testing
 # -------
 
@@ -185,6 +195,12 @@ scheduler_events = {
 # ]
 
 
+# Doctypes new WhatsApp Notifications can't be set up for, in addition to the
+# internal and log doctypes in frappe_whatsapp.utils.EXCLUDED_DOCTYPES.
+# Can also be set as `whatsapp_excluded_doctypes` in site config, and lifted
+# with `whatsapp_allowed_doctypes`.
+# whatsapp_excluded_doctypes = ["Stock Ledger Entry"]
+
 doc_events = {
     "*": {
         "before_insert": "frappe_whatsapp.utils.run_server_script_for_doc_event",
@@ -200,5 +216,10 @@ doc_events = {
         "after_delete": "frappe_whatsapp.utils.run_server_script_for_doc_event",
         "before_update_after_submit": "frappe_whatsapp.utils.run_server_script_for_doc_event",
         "on_update_after_submit": "frappe_whatsapp.utils.run_server_script_for_doc_event"
+    },
+    "User": {
+        "after_insert": "frappe_whatsapp.utils.recipients.clear_directory",
+        "on_update": "frappe_whatsapp.utils.recipients.clear_directory",
+        "on_trash": "frappe_whatsapp.utils.recipients.clear_directory"
     }
 }
@@ -0,0 +1,34 @@
+"""Clear duplicate message ids before message_id becomes unique."""
+import frappe
+
+
+def execute():
+    """Keep message_id on the oldest message, clear it on the duplicates."""
+    if not frappe.db.table_exists("WhatsApp Message"):
+        return
+
+    frappe.db.sql(
+        """UPDATE `tabWhatsApp Message`
+        SET message_id = NULL
+        WHERE message_id = ''"""
+    )
+
+    duplicates = frappe.db.sql_list(
+        """SELECT message_id FROM `tabWhatsApp Message`
+        WHERE message_id IS NOT NULL
+        GROUP BY message_id
+        HAVING COUNT(*) > 1"""
+    )
+    for message_id in duplicates:
+        names = frappe.get_all(
+            "WhatsApp Message",
+            filters={"message_id": message_id},
+            order_by="creation asc",
+            pluck="name",
+        )
+        frappe.db.sql(
+            """UPDATE `tabWhatsApp Message`
+            SET message_id = NULL
+            WHERE name IN %(names)s""",
+            {"names": tuple(names[1:])},
+        )
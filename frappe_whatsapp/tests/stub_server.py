@@ -0,0 +1,62 @@
+"""Local HTTP server answering with scripted responses, for client tests."""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+	"""Serve `responses` in order, one (status, body) per request, and record requests.
+
+	The last response is repeated once the script runs out.
+
+		with StubServer([(500, {}), (200, {"id": "1"})]) as server:
+			request("GET", server.url)
+	"""
+
+	def __init__(self, responses):
+		self.responses = list(responses)
+		self.requests = []
+		self._lock = threading.Lock()
+		self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+	@property
+	def url(self):
+		return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+	def __enter__(self):
+		self._thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def next_response(self, method, path, body):
+		with self._lock:
+			self.requests.append({"method": method, "path": path, "body": body})
+			if len(self.responses) > 1:
+				return self.responses.pop(0)
+			return self.responses[0]
+
+	def _make_handler(self):
+		stub = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def handle_one(self):
+				length = int(self.headers.get("content-length") or 0)
+				body = self.rfile.read(length).decode() if length else ""
+				status, payload = stub.next_response(self.command, self.path, body)
+				data = json.dumps(payload).encode()
+				self.send_response(status)
+				self.send_header("content-type", "application/json")
+				self.send_header("content-length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			do_GET = do_POST = do_DELETE = handle_one
+
+			def log_message(self, *args):
+				pass
+
+		return Handler
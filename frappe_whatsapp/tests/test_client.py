@@ -0,0 +1,47 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_whatsapp.tests.stub_server import StubServer
+from frappe_whatsapp.utils.client import get_session, make_request, request
+
+
+class TestClient(FrappeTestCase):
+	def session(self):
+		return get_session(pool_size=2, retries=2, backoff=0)
+
+	def test_get_is_retried_on_server_error(self):
+		with StubServer([(503, {}), (502, {}), (200, {"id": "1"})]) as server:
+			response = request("GET", server.url, session=self.session())
+
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(len(server.requests), 3)
+
+	def test_post_is_not_retried_on_server_error(self):
+		with StubServer([(500, {}), (200, {})]) as server:
+			response = request("POST", server.url, session=self.session(), data={"to": "1"})
+
+		self.assertEqual(response.status_code, 500)
+		self.assertEqual(len(server.requests), 1)
+
+	def test_post_is_retried_on_rate_limit(self):
+		with StubServer([(429, {}), (200, {"sent": True})]) as server:
+			response = request("POST", server.url, session=self.session(), data={"to": "1"})
+
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(len(server.requests), 2)
+		self.assertEqual(server.requests[-1]["body"], "to=1")
+
+	def test_retries_stop_at_limit(self):
+		with StubServer([(429, {})]) as server:
+			response = request("POST", server.url, session=self.session())
+
+		self.assertEqual(response.status_code, 429)
+		self.assertEqual(len(server.requests), 3)
+
+	def test_make_request_returns_json(self):
+		with StubServer([(200, {"messages": [{"id": "wamid.1"}]})]) as server:
+			response = make_request("POST", server.url, data={"to": "1"})
+
+		self.assertEqual(response["messages"][0]["id"], "wamid.1")
@@ -0,0 +1,48 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils.safe_exec import get_safe_globals, safe_eval
+
+from frappe_whatsapp.utils.condition import compile_condition, get_condition_fields, parse_field_comparison
+
+DOCS = (
+	frappe._dict(status="Paid", grand_total=100, customer="A"),
+	frappe._dict(status="Unpaid", grand_total=0, customer=None),
+	frappe._dict(status=None, grand_total=75, customer="B"),
+)
+
+CONDITIONS = (
+	"doc.status == 'Paid'",
+	"doc.status != 'Paid'",
+	"doc.status in ('Paid', 'Overdue')",
+	"doc.status not in ['Paid']",
+	"doc.grand_total == 0",
+	"doc.customer == None",
+	"doc.grand_total > 50",
+	"doc.status == 'Paid' and doc.grand_total",
+	"frappe.utils.cint(doc.grand_total) >= 100",
+)
+
+
+class TestCondition(FrappeTestCase):
+	def test_compiled_matches_safe_eval(self):
+		for condition in CONDITIONS:
+			evaluate = compile_condition(condition)
+			for doc in DOCS:
+				with self.subTest(condition=condition, doc=doc):
+					# same globals as the send path, frappe.utils included
+					expected = safe_eval(condition, get_safe_globals(), {"doc": doc})
+					self.assertEqual(bool(evaluate(doc)), bool(expected))
+
+	def test_fast_path(self):
+		self.assertTrue(parse_field_comparison("doc.status == 'Paid'"))
+		self.assertTrue(parse_field_comparison("doc.status in ('Paid', 'Overdue')"))
+		self.assertIsNone(parse_field_comparison("doc.grand_total > 50"))
+		self.assertIsNone(parse_field_comparison("doc.status in 'Paid'"))
+		self.assertIsNone(parse_field_comparison("doc._private == 1"))
+
+	def test_condition_fields(self):
+		self.assertEqual(get_condition_fields("doc.status == 'Paid' and doc.get('customer')"), {"status", "customer"})
+		self.assertIsNone(get_condition_fields("frappe.get_doc(doc).name"))
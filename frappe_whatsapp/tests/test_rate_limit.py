@@ -0,0 +1,57 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from frappe_whatsapp.utils.rate_limit import RateLimited, try_acquire, wait_for_capacity
+
+PHONE_ID = "test-rate-limit-phone"
+
+
+class TestRateLimit(FrappeTestCase):
+	def setUp(self):
+		cache = frappe.cache()
+		for key in cache.keys(cache.make_key(f"whatsapp_rate_limit*:{PHONE_ID}*")):
+			cache.delete(key)
+
+	def limits(self, phone=(10, 10), pair=(1, 2), tier=None):
+		limits = {"phone": phone, "pair": pair}
+		if tier:
+			limits["tier"] = tier
+		return patch("frappe_whatsapp.utils.rate_limit.get_limits", return_value=limits)
+
+	def test_pair_bucket_limits_one_destination(self):
+		with self.limits():
+			self.assertEqual(try_acquire(["911"], PHONE_ID), 0)
+			self.assertEqual(try_acquire(["911"], PHONE_ID), 0)
+			self.assertGreater(try_acquire(["911"], PHONE_ID), 0)
+			# other destinations still have their own burst
+			self.assertEqual(try_acquire(["912"], PHONE_ID), 0)
+
+	def test_all_or_nothing(self):
+		with self.limits(phone=(3, 3), pair=(1, 5)):
+			self.assertEqual(try_acquire(["911", "912"], PHONE_ID), 0)
+			# needs 2 phone tokens, 1 is left, nothing is taken
+			self.assertGreater(try_acquire(["913", "914"], PHONE_ID), 0)
+			self.assertEqual(try_acquire(["913"], PHONE_ID), 0)
+
+	def test_tier_bucket(self):
+		with self.limits(tier=(1 / 86400, 1)):
+			self.assertEqual(try_acquire(["911"], PHONE_ID), 0)
+			self.assertGreater(try_acquire(["912"], PHONE_ID), 3600)
+
+	def test_refill(self):
+		now = [1000.0]
+		with self.limits(phone=(10, 1), pair=(10, 1)), patch("time.time", lambda: now[0]):
+			self.assertEqual(try_acquire(["911"], PHONE_ID), 0)
+			self.assertAlmostEqual(try_acquire(["911"], PHONE_ID), 0.1)
+			now[0] += 0.1
+			self.assertEqual(try_acquire(["911"], PHONE_ID), 0)
+
+	def test_wait_for_capacity_raises_past_max_wait(self):
+		with self.limits(tier=(1 / 86400, 1)):
+			wait_for_capacity("911", PHONE_ID, max_wait=1)
+			self.assertRaises(RateLimited, wait_for_capacity, "912", PHONE_ID, max_wait=1)
@@ -0,0 +1,123 @@
+# Copyright (c) 2026, Shridhar Patil and Contributors
+# See license.txt
+
+import hashlib
+import hmac
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from frappe_whatsapp.utils.webhook import (
+	apply_message_statuses,
+	get_message_row,
+	insert_messages,
+	is_valid_payload,
+	is_valid_signature,
+	process_payload,
+)
+
+
+def get_payload(*messages):
+	return {
+		"object": "whatsapp_business_account",
+		"entry": [{"changes": [{"field": "messages", "value": {"messages": list(messages)}}]}],
+	}
+
+
+def get_message(message_id, message_type="text"):
+	message = {"id": message_id, "from": "919900000000", "type": message_type}
+	if message_type == "text":
+		message["text"] = {"body": "hello"}
+	else:
+		message[message_type] = {"id": f"media-{message_id}"}
+	return message
+
+
+class TestWebhook(FrappeTestCase):
+	def test_redelivered_message_is_inserted_once(self):
+		payload = get_payload(get_message("wamid.test-dedup-1"))
+		process_payload(payload)
+		process_payload(payload)
+
+		self.assertEqual(frappe.db.count("WhatsApp Message", {"message_id": "wamid.test-dedup-1"}), 1)
+
+	def test_media_download_only_for_inserted_rows(self):
+		payload = get_payload(get_message("wamid.test-dedup-2", "image"))
+		with patch("frappe_whatsapp.utils.webhook.enqueue_media_download") as enqueue:
+			process_payload(payload)
+			process_payload(payload)
+
+		self.assertEqual(enqueue.call_count, 1)
+		name = frappe.db.get_value("WhatsApp Message", {"message_id": "wamid.test-dedup-2"})
+		enqueue.assert_called_once_with(name, "media-wamid.test-dedup-2")
+
+	def test_duplicates_within_one_delivery(self):
+		message = get_message("wamid.test-dedup-3", "image")
+		with patch("frappe_whatsapp.utils.webhook.enqueue_media_download") as enqueue:
+			process_payload(get_payload(message, message))
+
+		self.assertEqual(frappe.db.count("WhatsApp Message", {"message_id": "wamid.test-dedup-3"}), 1)
+		self.assertEqual(enqueue.call_count, 1)
+
+	def test_concurrent_insert_of_same_message_id(self):
+		first = [get_message_row(get_message("wamid.test-dedup-4")), get_message_row(get_message("wamid.test-dedup-5"))]
+		self.assertEqual(len(insert_messages(first)), 2)
+
+		# a concurrent delivery inserted the ids after our lookup
+		rows = [get_message_row(get_message("wamid.test-dedup-4")), get_message_row(get_message("wamid.test-dedup-6"))]
+		with patch("frappe_whatsapp.utils.webhook.get_existing_message_ids", return_value=set()):
+			inserted = insert_messages(rows)
+
+		self.assertEqual(inserted, {rows[1]["name"]})
+		self.assertEqual(frappe.db.count("WhatsApp Message", {"message_id": "wamid.test-dedup-4"}), 1)
+		self.assertTrue(frappe.db.exists("WhatsApp Message", {"message_id": "wamid.test-dedup-6"}))
+
+	def test_status_never_moves_backwards(self):
+		process_payload(get_payload(get_message("wamid.test-status-1"), get_message("wamid.test-status-2")))
+
+		apply_message_statuses([
+			{"id": "wamid.test-status-1", "status": "read", "conversation": {"id": "conv-1"}},
+			{"id": "wamid.test-status-1", "status": "delivered"},
+			{"id": "wamid.test-status-2", "status": "delivered"},
+		])
+		# a late receipt for an earlier status is ignored
+		apply_message_statuses([
+			{"id": "wamid.test-status-1", "status": "sent"},
+			{"id": "wamid.test-status-2", "status": "read"},
+		])
+
+		self.assertEqual(
+			frappe.db.get_value("WhatsApp Message", {"message_id": "wamid.test-status-1"}, ["status", "conversation_id"]),
+			("read", "conv-1"),
+		)
+		self.assertEqual(frappe.db.get_value("WhatsApp Message", {"message_id": "wamid.test-status-2"}, "status"), "read")
+
+	def test_payload_shape(self):
+		self.assertTrue(is_valid_payload(get_payload(get_message("wamid.test-shape-1"))))
+		self.assertFalse(is_valid_payload({"object": "page", "entry": []}))
+		self.assertFalse(is_valid_payload({"object": "whatsapp_business_account"}))
+		self.assertFalse(is_valid_payload({"object": "whatsapp_business_account", "entry": ["x"]}))
+
+	def test_signature(self):
+		body = json.dumps(get_payload(get_message("wamid.test-signature-1"))).encode()
+		signature = "sha256=" + hmac.new(b"app-secret", body, hashlib.sha256).hexdigest()
+
+		def check(header):
+			headers = {"X-Hub-Signature-256": header} if header else {}
+			frappe.local.request = Request(EnvironBuilder(method="POST", data=body, headers=headers).get_environ())
+			with patch(
+				"frappe_whatsapp.utils.webhook.get_settings",
+				return_value=frappe._dict(app_secret="app-secret")
+			):
+				return is_valid_signature()
+
+		try:
+			self.assertTrue(check(signature))
+			self.assertFalse(check("sha256=" + "0" * 64))
+			self.assertFalse(check(None))
+		finally:
+			frappe.local.request = None
@@ -3,12 +3,35 @@ import frappe
 
 from frappe.core.doctype.server_script.server_script_utils import EVENT_MAP
 
+from frappe_whatsapp.utils.cache import get_cached_value, clear_cached_value
+from frappe_whatsapp.utils.scheduler import enqueue_scheduled_notifications
+
+# internal and log doctypes new notifications can't be set up for, extend
+# with the `whatsapp_excluded_doctypes` hook or site config key, lift with the
+# `whatsapp_allowed_doctypes` site config key
+EXCLUDED_DOCTYPES = (
+    "Access Log",
+    "Activity Log",
+    "Deleted Document",
+    "DocType",
+    "Error Log",
+    "Integration Request",
+    "Route History",
+    "Scheduled Job Log",
+    "Session Default Settings",
+    "Version",
+    "View Log",
+    "WhatsApp Broadcast",
+    "WhatsApp Notification",
+    "WhatsApp Notification Log",
+    "WhatsApp Settings",
+    "WhatsApp Templates",
+    "WhatsApp Webhook Inbox",
+)
+
 
 def run_server_script_for_doc_event(doc, event):
     """Run on each event."""
-    if event not in EVENT_MAP:
-        return
-
     if frappe.flags.in_install:
         return
 
@@ -18,41 +41,78 @@ def run_server_script_for_doc_event(doc, event):
     if frappe.flags.in_uninstall:
         return
 
+    if doc.doctype not in get_watched_doctypes():
+        return
+
+    if event not in EVENT_MAP:
+        return
+
     notification = get_notifications_map().get(
-        doc.doctype, {}
-    ).get(EVENT_MAP[event], None)
+        (doc.doctype, EVENT_MAP[event])
+    )
 
     if notification:
         # run all scripts for this doctype + event
         for notification_name in notification:
-            frappe.get_doc(
+            frappe.get_cached_doc(
                 "WhatsApp Notification",
                 notification_name
             ).send_template_message(doc)
 
 
 def get_notifications_map():
-    """Get mapping."""
+    """Get mapping of (doctype, event) to notification names."""
+    return get_dispatch_index().events
+
+
+def get_watched_doctypes():
+    """Get frozenset of doctypes having at least one notification."""
+    return get_dispatch_index().doctypes
+
+
+def get_dispatch_index():
+    """Get cached dispatch index."""
     if frappe.flags.in_patch and not frappe.db.table_exists("WhatsApp Notification"):
-        return {}
+        return frappe._dict(doctypes=frozenset(), events={})
+
+    return get_cached_value("whatsapp_notification_map", build_dispatch_index)
+
+
+def build_dispatch_index():
+    """Build dispatch index from enabled notifications.
 
+    Doctypes without notifications are skipped by the watched set, so every
+    enabled notification is indexed, on excluded doctypes too.
+    """
     notification_map = {}
     enabled_whatsapp_notifications = frappe.get_all(
         "WhatsApp Notification",
         fields=("name", "reference_doctype", "doctype_event", "notification_type"),
-        filters={"disabled": 0},
+        filters={"disabled": 0, "notification_type": "DocType Event"},
     )
     for notification in enabled_whatsapp_notifications:
-        if notification.notification_type == "DocType Event":
-            notification_map.setdefault(
-                notification.reference_doctype, {}
-            ).setdefault(
-                notification.doctype_event, []
-            ).append(notification.name)
+        notification_map.setdefault(
+            (notification.reference_doctype, notification.doctype_event), []
+        ).append(notification.name)
 
-    frappe.cache().set_value("whatsapp_notification_map", notification_map)
+    return frappe._dict(
+        doctypes=frozenset(doctype for doctype, event in notification_map),
+        events=notification_map
+    )
+
+
+def get_excluded_doctypes():
+    """Get doctypes new notifications can't be set up for."""
+    excluded = set(EXCLUDED_DOCTYPES)
+    excluded.update(frappe.get_hooks("whatsapp_excluded_doctypes"))
+    excluded.update(frappe.conf.get("whatsapp_excluded_doctypes") or [])
+    excluded.difference_update(frappe.conf.get("whatsapp_allowed_doctypes") or [])
+    return frozenset(excluded)
 
-    return notification_map
+
+def clear_notifications_map():
+    """Invalidate mapping."""
+    clear_cached_value("whatsapp_notification_map")
 
 
 def trigger_whatsapp_notifications_all():
@@ -107,8 +167,4 @@ def trigger_whatsapp_notifications_monthly_long():
 
 def trigger_whatsapp_notifications(event):
     """Run cron."""
-    frappe.get_doc(
-        "WhatsApp Notification",
-        frappe.db.get_value("WhatsApp Notification", filters={"event_frequency": event})
-    ).send_scheduled_message()
-    pass
+    enqueue_scheduled_notifications(event)
@@ -0,0 +1,85 @@
+"""Concurrent sender for fan-out messages."""
+import asyncio
+import time
+
+import frappe
+import httpx
+
+from frappe_whatsapp.utils.client import POST_RETRY_STATUSES, get_config
+from frappe_whatsapp.utils.rate_limit import MAX_WAIT, try_acquire
+
+
+def send_to_many(url, payloads, headers=None, concurrency=None, as_json=False):
+    """Post every payload to url concurrently, returns one result per payload.
+
+    Runs a single event loop for the whole batch; at most `concurrency`
+    requests (site config `whatsapp_send_concurrency`, default 20) are in
+    flight at any time, and each send waits for the shared rate limiter.
+    Payloads are form encoded unless `as_json` is set. A payload that gets
+    no rate limit tokens within MAX_WAIT seconds is not sent, its result has
+    `queued` set.
+    """
+    if not payloads:
+        return []
+
+    concurrency = concurrency or frappe.conf.get("whatsapp_send_concurrency") or 20
+    return asyncio.run(_send_all(url, payloads, headers or {}, concurrency, get_config(), as_json))
+
+
+async def _send_all(url, payloads, headers, concurrency, config, as_json=False):
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(config.timeout[1], connect=config.timeout[0])
+
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        return await asyncio.gather(*(
+            _send(client, semaphore, url, payload, headers, config, as_json)
+            for payload in payloads
+        ))
+
+
+async def _send(client, semaphore, url, payload, headers, config, as_json=False):
+    result = frappe._dict(to=payload.get("to"), ok=False)
+    async with semaphore:
+        if not await _wait_for_capacity(payload.get("to")):
+            result.queued = True
+            result.error = "rate limited"
+            return result
+
+        for attempt in range(config.retries + 1):
+            try:
+                if as_json:
+                    response = await client.post(url, json=payload, headers=headers)
+                else:
+                    response = await client.post(url, data=payload, headers=headers)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # never reached the server, safe to send again
+                result.error = str(e)
+            except httpx.HTTPError as e:
+                result.error = str(e)
+                break
+            else:
+                result.status_code = response.status_code
+                result.response = response.text
+                if response.status_code not in POST_RETRY_STATUSES:
+                    result.ok = response.is_success
+                    break
+
+            if attempt < config.retries:
+                await asyncio.sleep(config.backoff * (2 ** attempt))
+
+    return result
+
+
+async def _wait_for_capacity(to, max_wait=MAX_WAIT):
+    """Wait for a token, returns False when none frees up within `max_wait` seconds."""
+    deadline = time.monotonic() + max_wait
+    while to:
+        wait = try_acquire([to])
+        if not wait:
+            return True
+        if time.monotonic() + wait > deadline:
+            return False
+        await asyncio.sleep(wait)
+
+    return True
@@ -0,0 +1,402 @@
+"""Template broadcasts to large recipient lists."""
+import json
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import cint, now_datetime
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+from frappe_whatsapp.utils.async_sender import send_to_many
+from frappe_whatsapp.utils.cache import acquire_slot, is_slot_held, release_slot, renew_slot
+from frappe_whatsapp.utils.outbound import get_queue
+from frappe_whatsapp.utils.recipients import normalize_number
+from frappe_whatsapp.utils.templates import (
+    fill_payload,
+    format_parameters,
+    get_payload_plan,
+    get_template,
+    render_body,
+)
+
+# default for site config `whatsapp_broadcast_rate`, messages per second per
+# phone number id
+BROADCAST_RATE = 20
+
+# default recipients resolved, inserted and sent per batch
+BATCH_SIZE = 500
+
+# seconds one job sends before it hands over to a fresh job, well within
+# SEND_SLOT_TTL and the long queue timeout
+JOB_TIME_LIMIT = 5 * 60
+
+# seconds after which a crashed broadcast job frees its phone number
+SEND_SLOT_TTL = 10 * 60
+
+MESSAGE_FIELDS = (
+    "name", "creation", "modified", "owner", "modified_by",
+    "type", "status", "to", "template", "template_parameters", "template_header_parameters", "message",
+    "message_type", "priority", "content_type", "reference_doctype", "reference_name", "broadcast",
+)
+
+
+def enqueue_broadcast(broadcast):
+    frappe.enqueue(
+        "frappe_whatsapp.utils.broadcast.run_broadcast",
+        queue=get_queue("Bulk"),
+        enqueue_after_commit=True,
+        broadcast=broadcast,
+    )
+
+
+def enqueue_active_broadcasts():
+    """Pick up a queued broadcast or one whose job got lost, scheduled job.
+
+    Only one broadcast sends per phone number id, so nothing is enqueued
+    while a job holds the number. A running broadcast that reported progress
+    within SEND_SLOT_TTL is between jobs, its next job is queued already.
+    """
+    if is_slot_held(f"whatsapp_broadcast:{get_settings().phone_id}", 0):
+        return
+
+    for broadcast in frappe.get_all(
+        "WhatsApp Broadcast",
+        filters={"status": ("in", ("Queued", "Running"))},
+        fields=["name", "status"],
+        order_by="creation asc",
+    ):
+        if broadcast.status == "Running" and frappe.cache().get_value(f"whatsapp_broadcast_progress:{broadcast.name}"):
+            continue
+
+        enqueue_broadcast(broadcast.name)
+        return
+
+
+def run_broadcast(broadcast):
+    """Prepare and send a broadcast, background job.
+
+    One broadcast sends per phone number id at a time, paced to
+    `messages_per_second`. A job that finds the number busy returns, the
+    broadcast stays queued until enqueue_active_broadcasts picks it up
+    again. Both preparing and sending resume where a stopped or crashed job
+    left off.
+    """
+    broadcast = frappe.get_doc("WhatsApp Broadcast", broadcast)
+    if broadcast.status not in ("Queued", "Running"):
+        return
+
+    settings = get_settings()
+    lock = f"whatsapp_broadcast:{settings.phone_id}"
+    if acquire_slot(lock, 1, SEND_SLOT_TTL) is None:
+        return
+
+    try:
+        broadcast.db_set("status", "Running", update_modified=False)
+        if not broadcast.recipients_prepared:
+            prepare_recipients(broadcast)
+        send_batches(broadcast, settings, lock)
+    except Exception:
+        frappe.db.rollback()
+        frappe.db.set_value("WhatsApp Broadcast", broadcast.name, "status", "Failed", update_modified=False)
+        frappe.log_error(title=f"WhatsApp Broadcast {broadcast.name} failed")
+    finally:
+        release_slot(lock, 0)
+
+
+def prepare_recipients(broadcast):
+    """Insert a queued WhatsApp Message per unique recipient, in batches."""
+    template = get_template(broadcast.template)
+    if not template:
+        frappe.throw(_("WhatsApp Template {0} not found").format(broadcast.template))
+
+    plan = None
+    if broadcast.reference_doctype and template.body_fields:
+        plan = get_payload_plan(template, broadcast.reference_doctype)
+
+    # numbers inserted by an earlier, interrupted run
+    seen = set(frappe.get_all("WhatsApp Message", filters={"broadcast": broadcast.name}, pluck="to"))
+    for batch in iter_recipient_batches(broadcast):
+        recipients = []
+        for number, reference_name in batch:
+            number = normalize_number(str(number or ""))
+            if number and number not in seen:
+                seen.add(number)
+                recipients.append((number, reference_name))
+
+        insert_messages(broadcast, template, plan, recipients)
+        frappe.db.set_value(
+            "WhatsApp Broadcast", broadcast.name, "total_recipients", len(seen), update_modified=False
+        )
+        frappe.db.commit()
+
+    frappe.db.set_value(
+        "WhatsApp Broadcast",
+        broadcast.name,
+        {"total_recipients": len(seen), "recipients_prepared": 1},
+        update_modified=False,
+    )
+    frappe.db.commit()
+
+
+def iter_recipient_batches(broadcast):
+    """Yield batches of (number, reference name) from the broadcast's source."""
+    batch_size = cint(broadcast.batch_size) or BATCH_SIZE
+
+    if broadcast.recipient_source == "Recipient List":
+        rows = [(row.mobile_no, row.reference_name) for row in broadcast.recipients]
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+    elif broadcast.recipient_source == "DocType Filter":
+        start = 0
+        while True:
+            rows = frappe.get_all(
+                broadcast.reference_doctype,
+                filters=frappe.parse_json(broadcast.filters or "{}"),
+                fields=["name", broadcast.mobile_field],
+                order_by="name asc",
+                limit_start=start,
+                limit=batch_size,
+                as_list=True,
+            )
+            if not rows:
+                return
+            yield [(number, name) for name, number in rows]
+            start += batch_size
+
+    elif broadcast.recipient_source == "Report":
+        from frappe.desk.query_report import run
+
+        result = run(broadcast.report, filters=frappe.parse_json(broadcast.report_filters or "{}"))
+        columns = [
+            column.get("fieldname") if isinstance(column, dict) else frappe.scrub(column.split(":")[0])
+            for column in result.get("columns") or []
+        ]
+        rows = []
+        for row in result.get("result") or []:
+            if isinstance(row, (list, tuple)):
+                row = dict(zip(columns, row))
+            if isinstance(row, dict):
+                rows.append((row.get(broadcast.mobile_field), row.get("name")))
+
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+
+def insert_messages(broadcast, template, plan, recipients):
+    """Bulk insert queued messages with template parameters formatted per recipient."""
+    if not recipients:
+        return
+
+    reference_rows = {}
+    if plan and plan.columns:
+        reference_rows = {
+            row.name: row for row in frappe.get_all(
+                broadcast.reference_doctype,
+                filters={"name": ("in", [name for number, name in recipients if name])},
+                fields=list({"name", *plan.columns}),
+            )
+        }
+
+    now = now_datetime()
+    user = frappe.session.user
+    values = []
+    for number, reference_name in recipients:
+        parameters, header_parameters = [], []
+        if plan:
+            parameters, header_parameters = format_parameters(
+                plan, reference_rows.get(reference_name) or frappe._dict()
+            )
+
+        values.append((
+            frappe.generate_hash(length=10), now, now, user, user,
+            "Outgoing", "Queued", number, template.name, json.dumps(parameters), json.dumps(header_parameters),
+            render_body(template.body, parameters),
+            "Template", "Bulk", "text", broadcast.reference_doctype, reference_name, broadcast.name,
+        ))
+
+    # bulk_insert skips after_insert, messages are sent by the broadcast job
+    # and not through the outgoing queue
+    frappe.db.bulk_insert("WhatsApp Message", MESSAGE_FIELDS, values)
+
+
+def send_batches(broadcast, settings, lock):
+    """Send queued messages of the broadcast as template messages, paced per second.
+
+    Every chunk is claimed, Queued to Sending, and committed before it is
+    posted, so a killed job never sends a message twice. Rows a killed job
+    left in Sending are marked Failed once nothing is queued.
+    """
+    rate = cint(broadcast.messages_per_second) or frappe.conf.get("whatsapp_broadcast_rate") or BROADCAST_RATE
+    batch_size = cint(broadcast.batch_size) or BATCH_SIZE
+    template = get_template(broadcast.template)
+    if not template:
+        frappe.throw(_("WhatsApp Template {0} not found").format(broadcast.template))
+
+    plan = get_payload_plan(template, broadcast.reference_doctype)
+    url = f"{settings.url}/{settings.version}/{settings.phone_id}/messages"
+    headers = {
+        "authorization": f"Bearer {settings.token}",
+        "content-type": "application/json",
+    }
+
+    deadline = time.monotonic() + JOB_TIME_LIMIT
+    while time.monotonic() < deadline:
+        if frappe.db.get_value("WhatsApp Broadcast", broadcast.name, "status") != "Running":
+            # stopped from the form
+            return
+
+        messages = frappe.get_all(
+            "WhatsApp Message",
+            filters={"broadcast": broadcast.name, "status": "Queued"},
+            fields=["name", "to", "template_parameters", "template_header_parameters"],
+            order_by="name asc",
+            limit=batch_size,
+        )
+        if not messages:
+            fail_unsent_messages(broadcast.name)
+            update_progress(broadcast.name, completed=True)
+            return
+
+        for start in range(0, len(messages), rate):
+            started = time.monotonic()
+            chunk = claim_messages(messages[start:start + rate])
+            frappe.db.commit()
+
+            results = send_to_many(
+                url,
+                [
+                    fill_payload(
+                        plan,
+                        message.to,
+                        json.loads(message.template_parameters or "[]"),
+                        json.loads(message.template_header_parameters or "[]"),
+                    )
+                    for message in chunk
+                ],
+                headers=headers,
+                as_json=True,
+            )
+            queued = set_message_statuses(chunk, results)
+            frappe.db.commit()
+            renew_slot(lock, 0, SEND_SLOT_TTL)
+
+            if queued:
+                # out of tokens, enqueue_active_broadcasts resumes once the
+                # progress key expires instead of this job spinning
+                update_progress(broadcast.name)
+                frappe.db.commit()
+                return
+
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(max(0, 1 - (time.monotonic() - started)))
+
+        update_progress(broadcast.name)
+        frappe.db.commit()
+
+    # more left, continue in a fresh job
+    enqueue_broadcast(broadcast.name)
+
+
+def claim_messages(messages):
+    """Move messages from Queued to Sending, returns the ones claimed."""
+    names = [message.name for message in messages]
+    frappe.db.sql(
+        """UPDATE `tabWhatsApp Message`
+        SET status = 'Sending', modified = %s
+        WHERE name IN %s AND status = 'Queued'""",
+        (now_datetime(), names)
+    )
+    claimed = set(frappe.get_all(
+        "WhatsApp Message", filters={"name": ("in", names), "status": "Sending"}, pluck="name"
+    ))
+    return [message for message in messages if message.name in claimed]
+
+
+def fail_unsent_messages(broadcast):
+    """Mark messages a killed job claimed but never reported on as Failed."""
+    frappe.db.sql(
+        """UPDATE `tabWhatsApp Message`
+        SET status = 'Failed', modified = %s
+        WHERE broadcast = %s AND status = 'Sending'""",
+        (now_datetime(), broadcast)
+    )
+
+
+def set_message_statuses(messages, results):
+    """Store send outcomes, with the message id that status receipts refer to.
+
+    Messages held back by the rate limiter go back to Queued, returns them.
+    """
+    sent, failed, queued = {}, [], []
+    for message, result in zip(messages, results):
+        message_id = result.ok and get_message_id(result.response)
+        if result.get("queued"):
+            queued.append(message.name)
+        elif message_id:
+            sent[message.name] = message_id
+        else:
+            failed.append(message.name)
+
+    if sent:
+        frappe.db.sql(
+            f"""UPDATE `tabWhatsApp Message`
+            SET status = 'Success', message_id = CASE name {" ".join(["WHEN %s THEN %s"] * len(sent))} END,
+                modified = %s
+            WHERE name IN %s""",
+            [value for item in sent.items() for value in item] + [now_datetime(), list(sent)]
+        )
+    if failed:
+        frappe.db.sql(
+            """UPDATE `tabWhatsApp Message`
+            SET status = 'Failed', modified = %s
+            WHERE name IN %s""",
+            (now_datetime(), failed)
+        )
+    if queued:
+        frappe.db.sql(
+            """UPDATE `tabWhatsApp Message`
+            SET status = 'Queued', modified = %s
+            WHERE name IN %s""",
+            (now_datetime(), queued)
+        )
+
+    return queued
+
+
+def get_message_id(response):
+    try:
+        return json.loads(response)["messages"][0]["id"]
+    except (TypeError, ValueError, KeyError, IndexError):
+        return
+
+
+def update_progress(broadcast, completed=False):
+    """Store sent and failed counts and publish progress to the form.
+
+    Status receipts move sent messages on to sent, delivered, read or
+    failed, so everything past Queued and Sending counts as done.
+    """
+    counts = dict(frappe.db.sql(
+        """SELECT status, COUNT(*) FROM `tabWhatsApp Message`
+        WHERE broadcast = %s
+        GROUP BY status""",
+        broadcast
+    ))
+    total = sum(counts.values())
+    done = total - counts.get("Queued", 0) - counts.get("Sending", 0)
+    failed = counts.get("Failed", 0) + counts.get("failed", 0)
+    values = {
+        "sent": done - failed,
+        "failed": failed,
+        "progress": done * 100 / total if total else 100,
+    }
+    if completed:
+        values["status"] = "Completed"
+
+    frappe.db.set_value("WhatsApp Broadcast", broadcast, values, update_modified=False)
+    frappe.cache().set_value(f"whatsapp_broadcast_progress:{broadcast}", 1, expires_in_sec=SEND_SLOT_TTL)
+    frappe.publish_progress(
+        values["progress"], title=_("Sending broadcast"), doctype="WhatsApp Broadcast", docname=broadcast
+    )
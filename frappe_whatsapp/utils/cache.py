@@ -0,0 +1,92 @@
+"""Process and redis backed caches."""
+import frappe
+
+# {(site, key): (version, value)}
+_process_cache = {}
+
+# seconds a value stays in redis, values of replaced versions just expire
+VALUE_TTL = 24 * 60 * 60
+
+
+def get_cached_value(key, generator, process_only=False):
+    """Get value from process memory, fall back to redis and then generator.
+
+    Every cached key carries a version stamp in redis. The stamp is read
+    once per request (frappe keeps a request local copy of redis reads), so
+    a hit costs no SQL and at most one redis round trip per request.
+
+    Values are stored in redis under their version, so a worker that built
+    a value from rows read before an invalidation can only write it under
+    the old, already replaced version.
+
+    Values holding secrets should pass `process_only` to keep them out of
+    redis.
+    """
+    site = getattr(frappe.local, "site", None)
+    version = get_version(key)
+
+    cached = _process_cache.get((site, key))
+    if cached and cached[0] == version:
+        return cached[1]
+
+    if process_only:
+        value = generator()
+    else:
+        value = frappe.cache().get_value(f"{key}:{version}")
+        if value is None:
+            value = generator()
+            frappe.cache().set_value(f"{key}:{version}", value, expires_in_sec=VALUE_TTL)
+    _process_cache[(site, key)] = (version, value)
+    return value
+
+
+def get_version(key):
+    """Get version stamp of key."""
+    return frappe.cache().get_value(
+        f"{key}:version", generator=lambda: frappe.generate_hash(length=10)
+    )
+
+
+def clear_cached_value(key):
+    """Invalidate key in redis and, via the version stamp, in every process.
+
+    The stamp is bumped only once the current transaction commits. Bumping
+    it earlier would let a concurrent worker rebuild the value from the old
+    committed rows and store it under the new stamp.
+    """
+    frappe.db.after_commit.add(lambda: invalidate(key))
+
+
+def invalidate(key):
+    frappe.cache().delete_value(f"{key}:{get_version(key)}")
+    frappe.cache().set_value(f"{key}:version", frappe.generate_hash(length=10))
+    _process_cache.pop((getattr(frappe.local, "site", None), key), None)
+
+
+def acquire_slot(name, slots, ttl):
+    """Lease one of `slots` redis slots for `ttl` seconds, returns slot or None.
+
+    Used to cap how many background jobs of a kind run at the same time.
+    """
+    cache = frappe.cache()
+    for slot in range(slots or 1):
+        if cache.set(cache.make_key(f"{name}:{slot}"), 1, nx=True, ex=ttl):
+            return slot
+
+
+def renew_slot(name, slot, ttl):
+    """Extend lease of a slot held by a long running job."""
+    cache = frappe.cache()
+    cache.expire(cache.make_key(f"{name}:{slot}"), ttl)
+
+
+def release_slot(name, slot):
+    """Free a leased slot."""
+    cache = frappe.cache()
+    cache.delete(cache.make_key(f"{name}:{slot}"))
+
+
+def is_slot_held(name, slot):
+    """Check if a slot is leased by a running job."""
+    cache = frappe.cache()
+    return bool(cache.exists(cache.make_key(f"{name}:{slot}")))
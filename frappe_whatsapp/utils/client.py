@@ -0,0 +1,123 @@
+"""Shared HTTP client for WhatsApp API calls.
+
+One pooled keep-alive session per process, so sends reuse TCP and TLS
+connections instead of opening a new one per message. Tunable from site
+config:
+
+    whatsapp_http_pool_size: connections kept per host (default 20)
+    whatsapp_http_timeout: [connect, read] seconds (default [5, 30])
+    whatsapp_http_retries: retries with backoff (default 3), GET and DELETE
+        on 429/5xx, POST only on 429 and connection errors
+    whatsapp_http_backoff: backoff factor in seconds (default 0.5)
+"""
+import threading
+from urllib.parse import parse_qs
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# a 5xx or read timeout on POST may come after the message was accepted,
+# retrying it would send the message twice
+POST_RETRY_STATUSES = (429,)
+
+# {(pool_size, retries, backoff): requests.Session}
+_sessions = {}
+_lock = threading.Lock()
+
+
+def get_config():
+    """Get client config from site config."""
+    conf = frappe.conf if getattr(frappe.local, "conf", None) else {}
+    return frappe._dict(
+        pool_size=conf.get("whatsapp_http_pool_size") or 20,
+        timeout=tuple(conf.get("whatsapp_http_timeout") or (5, 30)),
+        retries=conf.get("whatsapp_http_retries", 3),
+        backoff=conf.get("whatsapp_http_backoff", 0.5),
+    )
+
+
+def get_session(pool_size=None, retries=None, backoff=None):
+    """Get pooled session, created once per process and config."""
+    config = get_config()
+    key = (
+        pool_size or config.pool_size,
+        config.retries if retries is None else retries,
+        config.backoff if backoff is None else backoff,
+    )
+
+    session = _sessions.get(key)
+    if session:
+        return session
+
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = make_session(*key)
+
+    return _sessions[key]
+
+
+class SendRetry(Retry):
+    """Retry idempotent requests on RETRY_STATUSES, POST only on POST_RETRY_STATUSES.
+
+    POST is left out of `allowed_methods`, so read errors are not retried
+    for it; connection errors are, as nothing was sent.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "POST":
+            return bool(self.total) and status_code in POST_RETRY_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def make_session(pool_size, retries, backoff):
+    """Make a keep-alive session with connection pooling and retries."""
+    retry = SendRetry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(("GET", "DELETE")),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def request(method, url, session=None, **kwargs):
+    """Send request through the pooled session, returns `requests.Response`."""
+    kwargs.setdefault("timeout", get_config().timeout)
+    return (session or get_session()).request(method, url, **kwargs)
+
+
+def make_request(method, url, headers=None, data=None, json=None, params=None):
+    """Drop in replacement for `frappe.integrations.utils.make_request`."""
+    try:
+        frappe.flags.integration_request = request(
+            method, url, headers=headers or {}, data=data or {}, json=json, params=params
+        )
+        frappe.flags.integration_request.raise_for_status()
+
+        if frappe.flags.integration_request.headers.get("content-type") == "text/plain; charset=utf-8":
+            return parse_qs(frappe.flags.integration_request.text)
+
+        return frappe.flags.integration_request.json()
+    except Exception as exc:
+        frappe.log_error()
+        raise exc
+
+
+def make_post_request(url, **kwargs):
+    """Drop in replacement for `frappe.integrations.utils.make_post_request`."""
+    return make_request("POST", url, **kwargs)
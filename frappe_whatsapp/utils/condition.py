@@ -0,0 +1,136 @@
+"""Compiled notification conditions."""
+import ast
+import operator
+import unicodedata
+
+import frappe
+from frappe.utils.safe_exec import WHITELISTED_SAFE_EVAL_GLOBALS, _validate_safe_eval_syntax, get_safe_globals
+
+try:
+    from frappe.utils.safe_exec import FrappeTransformer
+    from RestrictedPython import compile_restricted_eval
+except ImportError:
+    # frappe versions that eval conditions without RestrictedPython
+    FrappeTransformer = None
+
+# {(site, notification name): (modified, evaluator)}
+_conditions = {}
+
+# comparisons evaluated without the sandbox
+FAST_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.In: lambda value, options: value in options,
+    ast.NotIn: lambda value, options: value not in options,
+}
+
+
+def evaluate_condition(notification, doc):
+    """Evaluate notification condition against document data.
+
+    The condition is compiled once per notification version. Simple field
+    comparisons like `doc.status == 'Paid'` skip the sandbox altogether.
+    """
+    if not notification.condition:
+        return True
+
+    key = (getattr(frappe.local, "site", None), notification.name)
+    cached = _conditions.get(key)
+    if not cached or cached[0] != notification.modified:
+        cached = _conditions[key] = (notification.modified, compile_condition(notification.condition))
+
+    return cached[1](doc)
+
+
+def compile_condition(condition):
+    """Compile condition into a callable taking document data."""
+    condition = unicodedata.normalize("NFKC", condition).strip()
+    fast = parse_field_comparison(condition)
+    if fast:
+        fieldname, compare, value = fast
+        return lambda doc: compare(doc.get(fieldname), value)
+
+    _validate_safe_eval_syntax(condition)
+    if FrappeTransformer:
+        code = compile_restricted_eval(condition, filename="<safe_eval>", policy=FrappeTransformer).code
+    else:
+        code = compile(condition, "<safe_eval>", "eval")
+
+    return lambda doc: eval(code, get_eval_globals(), dict(doc=doc))  # nosec
+
+
+def parse_field_comparison(condition):
+    """Parse `doc.field <op> literal`, returns (fieldname, compare, value) or None."""
+    try:
+        tree = ast.parse(condition, mode="eval").body
+    except SyntaxError:
+        return
+
+    if not (
+        isinstance(tree, ast.Compare)
+        and len(tree.ops) == 1
+        and type(tree.ops[0]) in FAST_OPERATORS
+        and isinstance(tree.left, ast.Attribute)
+        and isinstance(tree.left.value, ast.Name)
+        and tree.left.value.id == "doc"
+        and not tree.left.attr.startswith("_")
+    ):
+        return
+
+    try:
+        value = ast.literal_eval(tree.comparators[0])
+    except (ValueError, TypeError):
+        return
+
+    if isinstance(tree.ops[0], (ast.In, ast.NotIn)) and not isinstance(value, (tuple, list, set)):
+        return
+
+    return tree.left.attr, FAST_OPERATORS[type(tree.ops[0])], value
+
+
+def get_condition_fields(condition):
+    """Get document fields read by condition, None if it uses the document as a whole."""
+    try:
+        tree = ast.parse(unicodedata.normalize("NFKC", condition).strip(), mode="eval")
+    except SyntaxError:
+        return
+
+    parents = {child: node for node in ast.walk(tree) for child in ast.iter_child_nodes(node)}
+    fields = set()
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Name) and node.id == "doc"):
+            continue
+
+        parent = parents.get(node)
+        if isinstance(parent, ast.Attribute) and parent.attr != "get":
+            # doc.field
+            fields.add(parent.attr)
+            continue
+
+        if isinstance(parent, ast.Attribute):
+            # doc.get("field")
+            parent, key = parents.get(parent), None
+            if isinstance(parent, ast.Call) and parent.args:
+                key = parent.args[0]
+        elif isinstance(parent, ast.Subscript) and parent.value is node:
+            # doc["field"]
+            key = parent.slice
+        else:
+            return
+
+        if not (isinstance(key, ast.Constant) and isinstance(key.value, str)):
+            return
+        fields.add(key.value)
+
+    return fields
+
+
+def get_eval_globals():
+    """Get safe globals, built once per request or job."""
+    if getattr(frappe.local, "whatsapp_eval_globals", None) is None:
+        eval_globals = get_safe_globals()
+        eval_globals["__builtins__"] = {}
+        eval_globals.update(WHITELISTED_SAFE_EVAL_GLOBALS)
+        frappe.local.whatsapp_eval_globals = eval_globals
+
+    return frappe.local.whatsapp_eval_globals
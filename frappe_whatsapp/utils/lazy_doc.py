@@ -0,0 +1,54 @@
+"""Read-only document view that copies fields on first read."""
+import frappe
+from frappe.model import default_fields
+
+
+class LazyDoc:
+    """Read-only view of a document for notifications.
+
+    Unlike `doc.as_dict()`, which deep copies every field and child table
+    up front, a field is copied only when it is read, so a notification
+    whose condition fails costs only the fields the condition looks at.
+    """
+
+    __slots__ = ("_doc", "_values")
+
+    def __init__(self, doc):
+        object.__setattr__(self, "_doc", doc)
+        object.__setattr__(self, "_values", {})
+
+    def get(self, fieldname, default=None):
+        if fieldname not in self._values:
+            value = self._doc.get(fieldname)
+            if isinstance(value, list):
+                value = [row.as_dict() if hasattr(row, "as_dict") else row for row in value]
+            self._values[fieldname] = value
+
+        value = self._values[fieldname]
+        return default if value is None else value
+
+    __getitem__ = get
+
+    def __getattr__(self, fieldname):
+        if fieldname.startswith("_"):
+            raise AttributeError(fieldname)
+        return self.get(fieldname)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __contains__(self, fieldname):
+        return self.get(fieldname) is not None
+
+    def as_dict(self, fieldnames=None):
+        """Get plain dict of fields, all of them when `fieldnames` is None."""
+        if fieldnames is None:
+            return self._doc.as_dict()
+
+        meta = self._doc.meta
+        data = frappe._dict(doctype=self._doc.doctype, name=self._doc.name)
+        for fieldname in fieldnames:
+            if fieldname in default_fields or meta.has_field(fieldname):
+                data[fieldname] = self.get(fieldname)
+
+        return data
@@ -0,0 +1,121 @@
+"""Media download and upload helpers."""
+import hashlib
+import os
+
+import frappe
+from frappe import _
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+from frappe_whatsapp.utils.client import request
+
+CHUNK_SIZE = 64 * 1024
+
+# default for site config `whatsapp_max_media_size`, in bytes
+MAX_MEDIA_SIZE = 100 * 1024 * 1024
+
+# default for site config `whatsapp_media_cache_expiry`, in seconds, kept
+# below the 30 days uploaded media stays on the cloud api
+MEDIA_CACHE_EXPIRY = 25 * 24 * 60 * 60
+
+
+def enqueue_media_download(message, media_id):
+    """Download media of an incoming message in background."""
+    frappe.enqueue(
+        "frappe_whatsapp.utils.media.attach_incoming_media",
+        queue="long",
+        enqueue_after_commit=True,
+        message=message,
+        media_id=media_id
+    )
+
+
+def attach_incoming_media(message, media_id):
+    """Download media and attach it to the incoming message, background job."""
+    if not frappe.db.exists("WhatsApp Message", message):
+        # duplicate delivery, row was never inserted
+        return
+
+    text = frappe.db.get_value("WhatsApp Message", message, "message")
+
+    file_doc = download_media(media_id, "WhatsApp Message", message, "attach")
+    frappe.db.set_value(
+        "WhatsApp Message", message,
+        {"attach": file_doc.file_url, "message": text or file_doc.file_url}
+    )
+
+
+def download_media(media_id, attached_to_doctype=None, attached_to_name=None, attached_to_field=None):
+    """Stream media from the cloud api into a content addressed public file.
+
+    Chunks are written straight to disk and hashed on the way, memory use
+    stays at CHUNK_SIZE whatever the file size.
+    """
+    settings = get_settings()
+    headers = {"Authorization": f"Bearer {settings.token}"}
+    max_size = frappe.conf.get("whatsapp_max_media_size") or MAX_MEDIA_SIZE
+
+    response = request("GET", f"{settings.url}/{settings.version}/{media_id}/", headers=headers)
+    response.raise_for_status()
+    media = response.json()
+    if int(media.get("file_size") or 0) > max_size:
+        frappe.throw(_("Media {0} exceeds the maximum size").format(media_id))
+
+    extension = (media.get("mime_type") or "application/octet-stream").split("/")[1].split(";")[0]
+    folder = frappe.get_site_path("public", "files")
+    temp_path = os.path.join(folder, f".{frappe.generate_hash(length=10)}.part")
+
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    size = 0
+    try:
+        with request("GET", media["url"], headers=headers, stream=True) as media_response:
+            media_response.raise_for_status()
+            with open(temp_path, "wb") as f:
+                for chunk in media_response.iter_content(chunk_size=CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        frappe.throw(_("Media {0} exceeds the maximum size").format(media_id))
+                    sha256.update(chunk)
+                    md5.update(chunk)
+                    f.write(chunk)
+
+        file_name = f"{sha256.hexdigest()[:32]}.{extension}"
+        os.replace(temp_path, os.path.join(folder, file_name))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "file_url": f"/files/{file_name}",
+        "is_private": 0,
+        "file_size": size,
+        "content_hash": md5.hexdigest(),
+        "attached_to_doctype": attached_to_doctype,
+        "attached_to_name": attached_to_name,
+        "attached_to_field": attached_to_field
+    }).insert(ignore_permissions=True)
+
+
+def get_file_hash(file_path):
+    """Get sha256 of a file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_registered_media(file_hash, kind):
+    """Get media id or handle uploaded earlier for the same content."""
+    return frappe.cache().get_value(f"whatsapp_media:{kind}:{file_hash}")
+
+
+def register_media(file_hash, kind, media_id):
+    """Remember uploaded media id or handle by content hash until it expires."""
+    frappe.cache().set_value(
+        f"whatsapp_media:{kind}:{file_hash}",
+        media_id,
+        expires_in_sec=frappe.conf.get("whatsapp_media_cache_expiry") or MEDIA_CACHE_EXPIRY
+    )
@@ -0,0 +1,97 @@
+"""Outbound send queue."""
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+# priority lane -> rq queue, override with site config `whatsapp_<lane>_queue`
+# to route a lane to a dedicated worker queue
+QUEUES = {
+    "Transactional": "short",
+    "Bulk": "long",
+    "Print": "long",
+}
+
+# re-enqueue queued messages whose job got lost after this many minutes
+STALE_AFTER_MINUTES = 10
+
+
+def get_queue(lane):
+    """Get rq queue for priority lane."""
+    lane = lane or "Transactional"
+    return frappe.conf.get(f"whatsapp_{lane.lower()}_queue") or QUEUES.get(lane, QUEUES["Transactional"])
+
+
+def enqueue_send(method, lane="Transactional", **kwargs):
+    """Enqueue a send job once the current transaction commits."""
+    frappe.enqueue(
+        method,
+        queue=get_queue(lane),
+        enqueue_after_commit=True,
+        now=frappe.flags.in_test,
+        **kwargs
+    )
+
+
+def enqueue_message(doc):
+    """Enqueue a queued WhatsApp Message."""
+    enqueue_send(
+        "frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_message.whatsapp_message.send_queued_message",
+        lane=doc.priority,
+        message=doc.name
+    )
+
+
+def defer_message(message, wait):
+    """Put a rate limited message back in Queued, sent again in about `wait` seconds.
+
+    No job is enqueued, `modified` is backdated so process_outgoing_queue
+    picks the row up once the wait is over.
+    """
+    frappe.db.set_value(
+        "WhatsApp Message",
+        message,
+        {
+            "status": "Queued",
+            "modified": add_to_date(now_datetime(), seconds=wait, minutes=-STALE_AFTER_MINUTES),
+        },
+        update_modified=False,
+    )
+
+
+def process_outgoing_queue():
+    """Re-enqueue messages stuck in Queued, scheduled job.
+
+    `modified` of re-enqueued rows is bumped, so a backlog gets one new job
+    per STALE_AFTER_MINUTES instead of one per scheduler tick. Rows left in
+    Sending by a crashed worker are marked Failed, not resent, since the
+    gateway may have accepted them.
+    """
+    stale = add_to_date(now_datetime(), minutes=-STALE_AFTER_MINUTES)
+    messages = frappe.get_all(
+        "WhatsApp Message",
+        filters={
+            "type": "Outgoing",
+            "status": "Queued",
+            # broadcast messages are sent by their broadcast job
+            "broadcast": ("is", "not set"),
+            "modified": ("<", stale),
+        },
+        fields=["name", "priority"],
+        order_by="creation asc",
+        limit=500,
+    )
+    if messages:
+        frappe.db.sql(
+            """UPDATE `tabWhatsApp Message`
+            SET modified = %s
+            WHERE name IN %s""",
+            (now_datetime(), [message.name for message in messages])
+        )
+    for message in messages:
+        enqueue_message(message)
+
+    frappe.db.sql(
+        """UPDATE `tabWhatsApp Message`
+        SET status = 'Failed', modified = %s
+        WHERE type = 'Outgoing' AND status = 'Sending' AND modified < %s""",
+        (now_datetime(), stale)
+    )
@@ -0,0 +1,169 @@
+"""Cached document PDFs."""
+import hashlib
+import hmac
+import time
+
+import frappe
+from frappe.utils import add_days, nowdate
+from frappe.utils.password import get_encryption_key
+from redis.exceptions import LockError
+
+from frappe_whatsapp.utils.cache import acquire_slot, release_slot
+
+PDF_PREFIX = "whatsapp-pdf-"
+
+# default for site config `whatsapp_pdf_cache_days`
+PDF_CACHE_DAYS = 7
+
+# seconds to wait for another worker rendering the same pdf
+RENDER_WAIT = 120
+
+# default for site config `whatsapp_pdf_concurrency`, renders running at once
+# across all workers
+PDF_CONCURRENCY = 2
+
+# seconds after which a crashed render frees its slot
+RENDER_SLOT_TTL = 600
+
+# seconds a notification job waits for a free render slot
+SLOT_WAIT = 30
+
+
+def get_pdf_url(doctype, name, print_format=None, ignore_permissions=False):
+    """Get download url of the document's pdf, rendered once per version.
+
+    Keyed by doctype, name, print format and the document's modified
+    timestamp. Concurrent callers for the same key wait on a redis lock and
+    reuse the file rendered by the first one. The file is private, the url
+    carries a token signed for its key so WhatsApp can fetch it.
+    """
+    if not ignore_permissions:
+        frappe.has_permission(doctype, "print", name, throw=True)
+
+    modified = frappe.db.get_value(doctype, name, "modified")
+    key = hashlib.sha1(f"{doctype}|{name}|{print_format}|{modified}".encode()).hexdigest()[:20]
+    cache_key = f"whatsapp_pdf:{key}"
+
+    cache = frappe.cache()
+    if cache.get_value(cache_key) and get_pdf_file(key):
+        return get_download_url(key)
+
+    # not getting the lock within RENDER_WAIT means the other render is stuck,
+    # render anyway, render_pdf still reuses a file saved in the meantime
+    lock = cache.lock(cache.make_key(f"whatsapp_pdf_lock:{key}"), timeout=RENDER_WAIT, blocking_timeout=RENDER_WAIT)
+    locked = lock.acquire()
+    rendered = False
+    try:
+        if not (cache.get_value(cache_key) and get_pdf_file(key)):
+            file_url = render_pdf(doctype, name, print_format, f"{PDF_PREFIX}{key}.pdf")
+            rendered = True
+    finally:
+        if locked and not rendered:
+            release_lock(lock)
+
+    if rendered:
+        def publish():
+            cache.set_value(cache_key, file_url, expires_in_sec=get_cache_days() * 24 * 60 * 60)
+            if locked:
+                release_lock(lock)
+
+        # the File row is visible to download_pdf and lock waiters only once
+        # committed, on rollback the lock expires after RENDER_WAIT
+        frappe.db.after_commit.add(publish)
+
+    return get_download_url(key)
+
+
+def release_lock(lock):
+    try:
+        lock.release()
+    except LockError:
+        # render outlasted the lock timeout, it expired already
+        pass
+
+
+def get_download_url(key):
+    return f"/api/method/frappe_whatsapp.utils.pdf.download_pdf?key={key}&token={get_token(key)}"
+
+
+def get_token(key):
+    return hmac.new(get_encryption_key().encode(), key.encode(), hashlib.sha256).hexdigest()
+
+
+@frappe.whitelist(allow_guest=True)
+def download_pdf(key, token):
+    """Serve a cached pdf to holders of its signed url."""
+    if not hmac.compare_digest(str(token), get_token(str(key))):
+        raise frappe.PermissionError
+
+    file_name = get_pdf_file(key)
+    if not file_name:
+        raise frappe.DoesNotExistError
+
+    file_doc = frappe.get_doc("File", file_name)
+    frappe.local.response.filename = file_doc.file_name
+    frappe.local.response.filecontent = file_doc.get_content()
+    frappe.local.response.type = "pdf"
+
+
+def get_pdf_file(key):
+    """Get name of the File holding the pdf rendered for key."""
+    return frappe.db.get_value("File", {"file_name": f"{PDF_PREFIX}{key}.pdf"})
+
+
+def get_pdf_url_if_slot_free(doctype, name, print_format=None, wait=SLOT_WAIT):
+    """Get pdf url once a render slot is free, returns None if none frees up in `wait` seconds.
+
+    Caps concurrent wkhtmltopdf renders from notification jobs at
+    `whatsapp_pdf_concurrency`. Permissions are not checked, the print is
+    attached by a notification set up by a System Manager.
+    """
+    slots = frappe.conf.get("whatsapp_pdf_concurrency") or PDF_CONCURRENCY
+    deadline = time.monotonic() + wait
+    while True:
+        slot = acquire_slot("whatsapp_pdf_render", slots, RENDER_SLOT_TTL)
+        if slot is not None:
+            break
+        if time.monotonic() >= deadline:
+            return
+        time.sleep(1)
+
+    try:
+        return get_pdf_url(doctype, name, print_format, ignore_permissions=True)
+    finally:
+        release_slot("whatsapp_pdf_render", slot)
+
+
+def render_pdf(doctype, name, print_format, file_name):
+    """Render print and save it as a private file, reusing an existing one."""
+    file_url = frappe.db.get_value("File", {"file_name": file_name}, "file_url")
+    if file_url:
+        return file_url
+
+    pdf = frappe.get_print(doctype, name, print_format, as_pdf=True)
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "content": pdf,
+        "is_private": 1
+    })
+    file_doc.save(ignore_permissions=True)
+    return file_doc.file_url
+
+
+def get_cache_days():
+    """Get days a rendered pdf is reused."""
+    return frappe.conf.get("whatsapp_pdf_cache_days") or PDF_CACHE_DAYS
+
+
+def delete_stale_pdfs():
+    """Delete cached pdfs older than the cache period, scheduled job."""
+    for file_name in frappe.get_all(
+        "File",
+        filters={
+            "file_name": ("like", f"{PDF_PREFIX}%"),
+            "creation": ("<", add_days(nowdate(), -get_cache_days())),
+        },
+        pluck="name",
+    ):
+        frappe.delete_doc("File", file_name, ignore_permissions=True)
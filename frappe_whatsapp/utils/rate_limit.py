@@ -0,0 +1,158 @@
+"""Redis token buckets shared by every send path."""
+import time
+
+import frappe
+from frappe import _
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+
+# default for site config `whatsapp_rate_limit`, messages per second per phone
+# number id, also the burst size
+PHONE_RATE = 80
+
+# default for site config `whatsapp_pair_rate_limit`, messages per minute to
+# one destination number, also the burst size
+PAIR_RATE_PER_MINUTE = 10
+
+# seconds a synchronous send waits for tokens before it is re-queued
+MAX_WAIT = 5
+
+# Takes `cost` tokens from every bucket or from none of them.
+# KEYS: stats hash, bucket hashes; ARGV: now, then rate, capacity, cost per
+# bucket. Returns seconds to wait as a string, "0" when granted.
+TOKEN_BUCKET = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i = 2, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 4])
+    local capacity = tonumber(ARGV[i * 3 - 3])
+    local cost = tonumber(ARGV[i * 3 - 2])
+    local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    available = math.min(capacity, available + math.max(0, now - ts) * rate)
+    tokens[i] = available
+    if available < cost then
+        wait = math.max(wait, (cost - available) / rate)
+    end
+end
+
+if wait > 0 then
+    redis.call('HINCRBY', KEYS[1], 'limited', 1)
+    return tostring(wait)
+end
+
+for i = 2, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 4])
+    local capacity = tonumber(ARGV[i * 3 - 3])
+    local cost = tonumber(ARGV[i * 3 - 2])
+    redis.call('HSET', KEYS[i], 'tokens', tokens[i] - cost, 'ts', now)
+    redis.call('EXPIRE', KEYS[i], math.ceil(capacity / rate) + 1)
+end
+redis.call('HINCRBY', KEYS[1], 'granted', 1)
+return '0'
+"""
+
+
+class RateLimited(frappe.ValidationError):
+    def __init__(self, message=None, wait=0):
+        super().__init__(message)
+        # seconds until tokens are back
+        self.wait = wait
+
+
+def get_limits():
+    """Get (rate per second, capacity) of the phone, pair and optional tier buckets."""
+    phone_rate = frappe.conf.get("whatsapp_rate_limit") or PHONE_RATE
+    pair_rate = frappe.conf.get("whatsapp_pair_rate_limit") or PAIR_RATE_PER_MINUTE
+    limits = {
+        "phone": (phone_rate, phone_rate),
+        "pair": (pair_rate / 60, pair_rate),
+    }
+
+    # messaging tier, messages per 24 hours, off unless configured
+    tier = frappe.conf.get("whatsapp_tier_limit")
+    if tier:
+        limits["tier"] = (tier / 86400, tier)
+
+    return limits
+
+
+def try_acquire(destinations, phone_id=None):
+    """Take one token per destination, returns seconds to wait, 0 when granted."""
+    destinations = [str(to) for to in destinations if to]
+    if not destinations:
+        return 0
+
+    phone_id = phone_id or get_settings().phone_id
+    limits = get_limits()
+    cache = frappe.cache()
+
+    keys = [cache.make_key(f"whatsapp_rate_limit_stats:{phone_id}")]
+    args = [time.time()]
+
+    def add(bucket, limit, cost):
+        keys.append(cache.make_key(f"whatsapp_rate_limit:{phone_id}:{bucket}"))
+        args.extend((limit[0], limit[1], cost))
+
+    # a cost above capacity could never be granted
+    add("phone", limits["phone"], min(len(destinations), limits["phone"][1]))
+    if "tier" in limits:
+        add("tier", limits["tier"], min(len(destinations), limits["tier"][1]))
+    for to in set(destinations):
+        add(f"to:{to}", limits["pair"], min(destinations.count(to), limits["pair"][1]))
+
+    return float(cache.register_script(TOKEN_BUCKET)(keys=keys, args=args))
+
+
+def wait_for_capacity(destinations, phone_id=None, max_wait=MAX_WAIT):
+    """Block until tokens are taken, raise RateLimited after `max_wait` seconds."""
+    if isinstance(destinations, str):
+        destinations = [destinations]
+
+    deadline = time.monotonic() + max_wait
+    while True:
+        wait = try_acquire(destinations, phone_id)
+        if not wait:
+            return
+
+        if time.monotonic() + wait > deadline:
+            raise RateLimited(
+                _("WhatsApp send rate limit reached, retry in {0} seconds").format(round(wait)), wait=wait
+            )
+        time.sleep(wait)
+
+
+@frappe.whitelist()
+def get_metrics(phone_id=None):
+    """Get token bucket utilisation and grant counts for a phone number id."""
+    frappe.only_for("System Manager")
+
+    phone_id = phone_id or get_settings().phone_id
+    cache = frappe.cache()
+    now = time.time()
+
+    buckets = {}
+    for bucket, (rate, capacity) in get_limits().items():
+        if bucket == "pair":
+            continue
+
+        tokens, ts = cache.hmget(cache.make_key(f"whatsapp_rate_limit:{phone_id}:{bucket}"), "tokens", "ts")
+        available = capacity
+        if tokens is not None:
+            available = min(capacity, float(tokens) + max(0, now - float(ts)) * rate)
+        buckets[bucket] = {
+            "rate_per_second": rate,
+            "capacity": capacity,
+            "available": available,
+            "utilisation": 1 - available / capacity,
+        }
+
+    stats = cache.hgetall(cache.make_key(f"whatsapp_rate_limit_stats:{phone_id}"))
+    return {
+        "phone_id": phone_id,
+        "buckets": buckets,
+        "granted": int(stats.get(b"granted") or 0),
+        "limited": int(stats.get(b"limited") or 0),
+    }
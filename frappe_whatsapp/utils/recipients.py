@@ -0,0 +1,69 @@
+"""Recipient directory."""
+import re
+
+import frappe
+
+from frappe_whatsapp.utils.cache import get_cached_value, clear_cached_value
+
+
+def get_role_recipients(roles):
+    """Get deduplicated phone numbers of enabled users having any of roles."""
+    directory = get_cached_value("whatsapp_recipient_directory", build_directory)
+
+    numbers = []
+    seen = set()
+    for role in roles:
+        for number in directory.get(role, ()):
+            if number not in seen:
+                seen.add(number)
+                numbers.append(number)
+
+    return numbers
+
+
+def build_directory():
+    """Build {role: (phone, ...)} for enabled users in one query."""
+    directory = {}
+    for role, phone in frappe.db.sql(
+        """SELECT has_role.role, user.phone
+        FROM `tabHas Role` has_role
+        INNER JOIN `tabUser` user ON user.name = has_role.parent
+        WHERE has_role.parenttype = 'User'
+            AND user.enabled = 1
+            AND ifnull(user.phone, '') != ''
+        ORDER BY user.creation""",
+    ):
+        number = normalize_number(phone)
+        if number:
+            directory.setdefault(role, []).append(number)
+
+    return {role: tuple(numbers) for role, numbers in directory.items()}
+
+
+def normalize_number(number):
+    """Strip formatting and leading + from number."""
+    return re.sub(r"[^\d]", "", number or "")
+
+
+def clear_directory(doc=None, method=None):
+    """Invalidate directory, hooked on User changes.
+
+    Roles are saved with the User, their own doc events never fire. A save
+    that changes neither phone, enabled nor roles keeps the directory.
+    """
+    if method == "on_update" and not directory_changed(doc):
+        return
+
+    clear_cached_value("whatsapp_recipient_directory")
+
+
+def directory_changed(user):
+    before = user.get_doc_before_save()
+    if not before:
+        return True
+
+    return (
+        user.phone != before.phone
+        or user.enabled != before.enabled
+        or {row.role for row in user.roles} != {row.role for row in before.roles}
+    )
@@ -0,0 +1,211 @@
+"""Paged, resumable runs of scheduled notifications."""
+import frappe
+from frappe.utils import add_to_date, getdate, nowdate
+
+from frappe_whatsapp.utils.cache import acquire_slot, release_slot
+from frappe_whatsapp.utils.condition import evaluate_condition
+from frappe_whatsapp.utils.lazy_doc import LazyDoc
+
+# documents selected per query
+PAGE_SIZE = 500
+
+# pages handled by one job before it hands over to a fresh job
+PAGES_PER_JOB = 20
+
+# seconds after which a crashed scheduled run frees its lock
+RUN_LOCK_TTL = 30 * 60
+
+
+def enqueue_date_notifications():
+    """Fan Days Before/After notifications out to one job each."""
+    for notification in frappe.get_all(
+        "WhatsApp Notification",
+        filters={"doctype_event": ("in", ("Days Before", "Days After")), "disabled": 0},
+        pluck="name",
+    ):
+        enqueue_date_notification(notification)
+
+
+def enqueue_date_notification(notification):
+    frappe.enqueue(
+        "frappe_whatsapp.utils.scheduler.run_date_notification",
+        queue="long",
+        enqueue_after_commit=True,
+        notification=notification,
+    )
+
+
+def run_date_notification(notification):
+    """Send a Days Before/After notification for today's documents, background job.
+
+    Documents are selected by date window in pages ordered by name. After
+    every page the last name is checkpointed on the notification, so a
+    crashed or timed out run resumes where it stopped and a finished run is
+    not repeated on the same day. Only one run per notification and day is
+    active at a time.
+    """
+    lock = f"whatsapp_date_notification:{notification}:{nowdate()}"
+    if acquire_slot(lock, 1, RUN_LOCK_TTL) is None:
+        return
+
+    try:
+        send_dated_documents(frappe.get_doc("WhatsApp Notification", notification))
+    finally:
+        release_slot(lock, 0)
+
+
+def send_dated_documents(notification):
+    today = getdate(nowdate())
+    if notification.last_completed_date and getdate(notification.last_completed_date) == today:
+        return
+
+    checkpoint = None
+    if notification.checkpoint_date and getdate(notification.checkpoint_date) == today:
+        checkpoint = notification.checkpoint_name
+
+    diff_days = notification.days_in_advance
+    if notification.doctype_event == "Days After":
+        diff_days = -diff_days
+
+    reference_date = add_to_date(nowdate(), days=diff_days)
+    filters = [
+        [notification.date_changed, ">=", reference_date + " 00:00:00.000000"],
+        [notification.date_changed, "<=", reference_date + " 23:59:59.000000"],
+    ]
+    full_docs = needs_children(notification)
+
+    for page in range(PAGES_PER_JOB):
+        rows = frappe.get_all(
+            notification.reference_doctype,
+            filters=filters + ([["name", ">", checkpoint]] if checkpoint else []),
+            fields=["*"],
+            order_by="name asc",
+            limit=PAGE_SIZE,
+        )
+        if not rows:
+            set_checkpoint(notification, today, checkpoint, completed=True)
+            return
+
+        send_page(notification, rows, full_docs)
+        checkpoint = rows[-1].name
+        set_checkpoint(notification, today, checkpoint)
+
+    # more pages left, continue in a fresh job
+    enqueue_date_notification(notification.name)
+
+
+def enqueue_scheduled_notifications(event_frequency):
+    """Fan Scheduler Event notifications of a frequency out to one job each."""
+    for notification in frappe.get_all(
+        "WhatsApp Notification",
+        filters={
+            "notification_type": "Scheduler Event",
+            "event_frequency": event_frequency,
+            "disabled": 0,
+        },
+        pluck="name",
+    ):
+        enqueue_scheduled_notification(notification)
+
+
+def enqueue_scheduled_notification(notification):
+    frappe.enqueue(
+        "frappe_whatsapp.utils.scheduler.run_scheduled_notification",
+        queue="long",
+        enqueue_after_commit=True,
+        notification=notification,
+    )
+
+
+def run_scheduled_notification(notification):
+    """Send a Scheduler Event notification for changed documents, background job.
+
+    Documents are selected by (modified, name) above the notification's
+    high-water mark, so a run only reads documents created or changed since
+    the previous one. The mark is moved after every page. On the first run
+    it starts at the notification's creation, not at the start of the table.
+    Only one run per notification is active at a time.
+    """
+    lock = f"whatsapp_scheduled_notification:{notification}"
+    if acquire_slot(lock, 1, RUN_LOCK_TTL) is None:
+        return
+
+    try:
+        send_changed_documents(frappe.get_doc("WhatsApp Notification", notification))
+    finally:
+        release_slot(lock, 0)
+
+
+def send_changed_documents(notification):
+    last_modified, last_name = notification.creation, ""
+    if notification.last_processed_modified:
+        last_modified = notification.last_processed_modified
+        last_name = notification.checkpoint_name or ""
+
+    full_docs = needs_children(notification)
+
+    for page in range(PAGES_PER_JOB):
+        rows = frappe.db.sql(
+            f"""
+            select * from `tab{notification.reference_doctype}`
+            where modified > %(modified)s or (modified = %(modified)s and name > %(name)s)
+            order by modified asc, name asc
+            limit {PAGE_SIZE}
+            """,
+            {"modified": last_modified, "name": last_name},
+            as_dict=True,
+        )
+        if not rows:
+            return
+
+        send_page(notification, rows, full_docs)
+        last_modified, last_name = rows[-1].modified, rows[-1].name
+        frappe.db.set_value(
+            "WhatsApp Notification",
+            notification.name,
+            {"last_processed_modified": last_modified, "checkpoint_name": last_name},
+            update_modified=False,
+        )
+        frappe.db.commit()
+
+        if len(rows) < PAGE_SIZE:
+            return
+
+    # more pages left, continue in a fresh job
+    enqueue_scheduled_notification(notification.name)
+
+
+def send_page(notification, rows, full_docs):
+    """Send notification for page rows that satisfy its condition."""
+    for row in rows:
+        if full_docs:
+            doc = frappe.get_doc(notification.reference_doctype, row.name)
+            doc_data = LazyDoc(doc)
+        else:
+            doc = None
+            doc_data = row
+
+        if not evaluate_condition(notification, doc_data):
+            continue
+
+        doc = doc or frappe.get_doc(dict(row, doctype=notification.reference_doctype))
+        notification.send_template_message(doc, lane="Bulk", check_condition=False)
+
+
+def needs_children(notification):
+    """Check if the notification reads child tables, which page rows don't carry."""
+    tables = {df.fieldname for df in frappe.get_meta(notification.reference_doctype).get_table_fields()}
+    if not tables:
+        return False
+
+    fields = notification.get_referenced_fields()
+    return fields is None or bool(tables & fields)
+
+
+def set_checkpoint(notification, run_date, name, completed=False):
+    values = {"checkpoint_date": run_date, "checkpoint_name": name}
+    if completed:
+        values["last_completed_date"] = run_date
+
+    frappe.db.set_value("WhatsApp Notification", notification.name, values, update_modified=False)
+    frappe.db.commit()
@@ -0,0 +1,193 @@
+"""Cached WhatsApp Templates metadata and payload plans."""
+import re
+from typing import NamedTuple
+
+import frappe
+from frappe.model import default_fields, no_value_fields, table_fields
+from frappe.model.meta import get_default_df
+
+from frappe_whatsapp.utils.cache import get_cached_value, clear_cached_value
+
+
+class TemplateMeta(NamedTuple):
+    """Immutable send-time view of a WhatsApp Templates record."""
+
+    name: str
+    actual_name: str
+    language_code: str
+    status: str
+    header_type: str
+    # reference document fields filling body and header parameters
+    body_fields: tuple
+    header_fields: tuple
+    body: str = ""
+
+
+class PayloadPlan(NamedTuple):
+    """Precompiled template message payload for one reference doctype."""
+
+    template: TemplateMeta
+    # columns read from the reference document in one query
+    columns: tuple
+    # (fieldname, docfield, currency fieldname) per parameter
+    body: tuple
+    header: tuple
+    skeleton: dict
+
+
+# {(site, template name, reference doctype): PayloadPlan}
+_plans = {}
+
+
+def get_template(name):
+    """Get template metadata, None if the template does not exist."""
+    return get_templates().get(name)
+
+
+def get_templates():
+    return get_cached_value("whatsapp_templates", build_templates)
+
+
+def build_templates():
+    """Build {template name: TemplateMeta} with components parsed once."""
+    templates = {}
+    for template in frappe.get_all(
+        "WhatsApp Templates",
+        fields=[
+            "name", "template_name", "actual_name", "language_code", "status",
+            "header_type", "template", "field_names", "sample_values", "sample",
+        ],
+    ):
+        body_fields = ()
+        if template.sample_values:
+            body_fields = split_fields(template.field_names or template.sample_values)
+
+        header_fields = ()
+        if template.header_type and template.sample:
+            header_fields = split_fields(template.sample)
+
+        templates[template.name] = TemplateMeta(
+            name=template.name,
+            actual_name=template.actual_name or template.template_name,
+            language_code=template.language_code,
+            status=template.status,
+            header_type=template.header_type,
+            body=template.template,
+            body_fields=body_fields,
+            header_fields=header_fields,
+        )
+
+    return templates
+
+
+def split_fields(value):
+    return tuple(field.strip() for field in value.split(","))
+
+
+def clear_templates():
+    """Invalidate template metadata in every process."""
+    clear_cached_value("whatsapp_templates")
+
+
+def get_payload_plan(template, doctype):
+    """Get payload plan of template for reference doctype, rebuilt when the template changes."""
+    key = (getattr(frappe.local, "site", None), template.name, doctype)
+    plan = _plans.get(key)
+    if not plan or plan.template != template:
+        plan = _plans[key] = build_payload_plan(template, doctype)
+
+    return plan
+
+
+def build_payload_plan(template, doctype):
+    # without a reference doctype parameters have nothing to read from
+    meta = frappe.get_meta(doctype) if doctype and (template.body_fields or template.header_fields) else None
+    columns = set()
+
+    def compile_fields(fieldnames):
+        parameters = []
+        for fieldname in fieldnames:
+            df = meta.get_field(fieldname) if meta else None
+            is_column = fieldname in default_fields or (
+                df and df.fieldtype not in no_value_fields
+                and df.fieldtype not in table_fields
+                and not df.get("is_virtual")
+            )
+            currency = None
+            if df and df.fieldtype == "Currency" and meta.get_field(df.options or ""):
+                currency = df.options
+                columns.add(currency)
+            if is_column:
+                columns.add(fieldname)
+            parameters.append((fieldname if is_column else None, df or get_default_df(fieldname), currency))
+
+        return tuple(parameters)
+
+    return PayloadPlan(
+        template=template,
+        body=compile_fields(template.body_fields),
+        header=compile_fields(template.header_fields),
+        columns=tuple(sorted(columns)),
+        skeleton={
+            "messaging_product": "whatsapp",
+            "type": "template",
+            "template": {
+                "name": template.actual_name,
+                "language": {"code": template.language_code},
+            },
+        },
+    )
+
+
+def build_payload(plan, to, reference_doctype, reference_name):
+    """Fill payload plan for a recipient, returns (payload, body values, header values)."""
+    row = frappe._dict()
+    if plan.columns:
+        row = frappe.db.get_value(reference_doctype, reference_name, plan.columns, as_dict=True) or row
+
+    body_values, header_values = format_parameters(plan, row)
+    return fill_payload(plan, to, body_values, header_values), body_values, header_values
+
+
+def fill_payload(plan, to, body_values, header_values):
+    """Get template message payload for a recipient from formatted parameter values."""
+    components = []
+    if plan.body:
+        components.append({
+            "type": "body",
+            "parameters": [{"type": "text", "text": value} for value in body_values],
+        })
+    if plan.header:
+        components.append({
+            "type": "header",
+            "parameters": [{"type": "text", "text": value} for value in header_values],
+        })
+
+    payload = dict(plan.skeleton, to=to)
+    payload["template"] = dict(plan.skeleton["template"], components=components)
+    return payload
+
+
+def format_parameters(plan, row):
+    """Format body and header parameter values from a row of the plan's columns."""
+    def fill(parameters):
+        return [
+            frappe.format_value(
+                row.get(fieldname) if fieldname else None,
+                df=df,
+                doc=row,
+                currency=row.get(currency) if currency else None,
+            )
+            for fieldname, df, currency in parameters
+        ]
+
+    return fill(plan.body), fill(plan.header)
+
+
+def render_body(body, values):
+    """Fill `{{1}}`, `{{2}}`.. placeholders of template body text."""
+    def replace(match):
+        index = int(match.group(1)) - 1
+        return str(values[index]) if index < len(values) else match.group()
+
+    return re.sub(r"\{\{\s*(\d+)\s*\}\}", replace, body or "")
@@ -0,0 +1,123 @@
+"""Resumable uploads to the cloud api."""
+import mmap
+import os
+
+import frappe
+import magic
+from frappe import _
+from requests.exceptions import RequestException
+
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+from frappe_whatsapp.utils.client import make_request
+from frappe_whatsapp.utils.media import get_file_hash
+
+# default for site config `whatsapp_upload_chunk_size`, in bytes
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# failed chunks are retried from the server side offset this many times
+MAX_RESUMES = 5
+
+# upload sessions stay valid on the cloud api for a day
+SESSION_EXPIRY = 24 * 60 * 60
+
+# responses to an offset lookup of an expired or unknown session
+SESSION_GONE_STATUSES = (400, 404)
+
+
+def upload_file(file_path, progress=None):
+    """Upload file in chunks with the resumable upload api, returns the file handle.
+
+    The file is memory mapped and sent chunk by chunk, so memory use does
+    not depend on the file size. The upload session is kept in redis by
+    content hash: a failed chunk, or a later call for the same file, resumes
+    from the offset the server already has.
+
+    `progress` is called with (uploaded bytes, total bytes) after each chunk.
+    """
+    settings = get_settings()
+    file_size = os.path.getsize(file_path)
+    if not file_size:
+        # nothing to upload, and an empty file can't be memory mapped
+        frappe.throw(_("Cannot upload empty file {0}").format(file_path))
+
+    chunk_size = frappe.conf.get("whatsapp_upload_chunk_size") or CHUNK_SIZE
+    session_key = f"whatsapp_upload_session:{settings.app_id}:{get_file_hash(file_path)}"
+
+    session_id = frappe.cache().get_value(session_key)
+    offset = 0
+    if session_id:
+        try:
+            offset = get_offset(settings, session_id)
+        except RequestException as e:
+            if is_client_error(e) and e.response.status_code not in SESSION_GONE_STATUSES:
+                raise
+            # session expired on the server, start over
+            session_id = None
+
+    if not session_id:
+        session_id = start_session(settings, file_path, file_size)
+        frappe.cache().set_value(session_key, session_id, expires_in_sec=SESSION_EXPIRY)
+
+    resumes = 0
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while True:
+            try:
+                response = make_request(
+                    "POST",
+                    f"{settings.url}/{settings.version}/{session_id}",
+                    headers={
+                        "authorization": f"OAuth {settings.token}",
+                        "file_offset": str(offset),
+                    },
+                    data=data[offset:offset + chunk_size],
+                )
+            except RequestException as e:
+                resumes += 1
+                if resumes > MAX_RESUMES or is_client_error(e):
+                    raise
+                offset = get_offset(settings, session_id)
+                continue
+
+            if response.get("h"):
+                frappe.cache().delete_value(session_key)
+                if progress:
+                    progress(file_size, file_size)
+                return response["h"]
+
+            offset = int(response.get("file_offset") or min(offset + chunk_size, file_size))
+            if offset >= file_size:
+                frappe.cache().delete_value(session_key)
+                frappe.throw(_("Upload of {0} finished without a file handle").format(file_path))
+            if progress:
+                progress(offset, file_size)
+
+
+def is_client_error(exc):
+    """Check if request failed with a 4xx other than 429, which resending won't fix."""
+    response = getattr(exc, "response", None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+
+def start_session(settings, file_path, file_size):
+    """Create upload session."""
+    response = make_request(
+        "POST",
+        f"{settings.url}/{settings.version}/{settings.app_id}/uploads",
+        headers={"authorization": f"Bearer {settings.token}"},
+        data={
+            "file_length": file_size,
+            "file_type": magic.Magic(mime=True).from_file(file_path),
+            "messaging_product": "whatsapp",
+        },
+    )
+    return response["id"]
+
+
+def get_offset(settings, session_id):
+    """Get number of bytes the server has received for session."""
+    response = make_request(
+        "GET",
+        f"{settings.url}/{settings.version}/{session_id}",
+        headers={"authorization": f"OAuth {settings.token}"},
+    )
+    return int(response.get("file_offset") or 0)
@@ -1,11 +1,32 @@
 """Webhook."""
 import frappe
+import hashlib
+import hmac
 import json
-import requests
 import time
 from werkzeug.wrappers import Response
 import frappe.utils
 
+from frappe_whatsapp.frappe_whatsapp.doctype.whatsapp_settings.whatsapp_settings import get_settings
+from frappe_whatsapp.utils.cache import acquire_slot, renew_slot, release_slot
+from frappe_whatsapp.utils.media import enqueue_media_download
+from frappe_whatsapp.utils.templates import clear_templates
+
+# seconds after which a crashed inbox worker frees its slot
+INBOX_WORKER_TTL = 600
+
+# seconds a received message id short-circuits redeliveries
+SEEN_MESSAGE_TTL = 24 * 60 * 60
+
+# receipts only move a message forward in this order
+STATUS_RANK = {
+	"sent": 1,
+	"delivered": 2,
+	"read": 3,
+	"played": 4,
+	"failed": 5,
+}
+
 
 @frappe.whitelist(allow_guest=True)
 def webhook():
@@ -18,9 +39,7 @@ def webhook():
 def get():
 	"""Get."""
 	hub_challenge = frappe.form_dict.get("hub.challenge")
-	webhook_verify_token = frappe.db.get_single_value(
-		"WhatsApp Settings", "webhook_verify_token"
-	)
+	webhook_verify_token = get_settings().webhook_verify_token
 
 	if frappe.form_dict.get("hub.verify_token") != webhook_verify_token:
 		frappe.throw("Verify token does not match")
@@ -29,135 +48,307 @@ def get():
 
 def post():
 	"""Post."""
+	if not is_valid_signature():
+		return Response("Signature does not match", status=403)
+
 	data = frappe.local.form_dict
+	if not is_valid_payload(data):
+		return Response("Not a WhatsApp Business Account payload", status=400)
+
+	if get_settings().defer_webhook_processing:
+		save_to_inbox(data)
+		return
+
 	frappe.get_doc({
 		"doctype": "WhatsApp Notification Log",
 		"template": "Webhook",
 		"meta_data": json.dumps(data)
 	}).insert(ignore_permissions=True)
 
-	messages = []
+	process_payload(data)
+	return
+
+def is_valid_signature():
+	"""Check X-Hub-Signature-256, the HMAC-SHA256 of the raw body keyed with the app secret.
+
+	Skipped until an App Secret is set in WhatsApp Settings.
+	"""
+	app_secret = get_settings().app_secret
+	if not app_secret:
+		return True
+
+	signature = frappe.request.headers.get("X-Hub-Signature-256") or ""
+	expected = hmac.new(app_secret.encode(), frappe.request.get_data(), hashlib.sha256).hexdigest()
+	return hmac.compare_digest(signature, f"sha256={expected}")
+
+def is_valid_payload(data):
+	"""Check payload is a WhatsApp Business Account delivery of entries with changes."""
+	if data.get("object") != "whatsapp_business_account":
+		return False
+
+	entries = data.get("entry")
+	if isinstance(entries, dict):
+		entries = [entries]
+
+	return bool(entries) and isinstance(entries, list) and all(
+		isinstance(entry, dict) and isinstance(entry.get("changes"), list)
+		for entry in entries
+	)
+
+def save_to_inbox(data):
+	"""Persist raw payload and leave processing to background workers."""
+	frappe.get_doc({
+		"doctype": "WhatsApp Webhook Inbox",
+		"status": "Pending",
+		"payload": json.dumps(data)
+	}).db_insert()
+	enqueue_inbox_worker()
+
+def enqueue_inbox_worker():
+	"""Start an inbox worker if less than the configured number are running."""
+	slot = acquire_slot("whatsapp_inbox_worker", get_settings().webhook_workers, INBOX_WORKER_TTL)
+	if slot is not None:
+		frappe.enqueue(
+			"frappe_whatsapp.utils.webhook.process_inbox",
+			queue="short",
+			enqueue_after_commit=True,
+			slot=slot
+		)
+
+def process_inbox(slot=None):
+	"""Apply pending inbox payloads until none are left, background job."""
 	try:
-		messages = data["entry"][0]["changes"][0]["value"].get("messages", [])
-	except KeyError:
-		messages = data["entry"]["changes"][0]["value"].get("messages", [])
+		while process_next_inbox_entry():
+			if slot is not None:
+				renew_slot("whatsapp_inbox_worker", slot, INBOX_WORKER_TTL)
+	finally:
+		if slot is not None:
+			release_slot("whatsapp_inbox_worker", slot)
 
-	if messages:
-		for message in messages:
-			message_type = message['type']
-			is_reply = True if message.get('context') else False
-			reply_to_message_id = message['context']['id'] if is_reply else None
-			if message_type == 'text':
-				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
-					"message": message['text']['body'],
-					"message_id": message['id'],
-					"reply_to_message_id": reply_to_message_id,
-					"is_reply": is_reply,
-					"content_type":message_type
-				}).insert(ignore_permissions=True)
-			elif message_type == 'reaction':
-				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
-					"message": message['reaction']['emoji'],
-					"reply_to_message_id": message['reaction']['message_id'],
-					"message_id": message['id'],
-					"content_type": "reaction"
-				}).insert(ignore_permissions=True)
-			elif message_type == 'interactive':
-				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
-					"message": message['interactive']['nfm_reply']['response_json'],
-					"message_id": message['id'],
-					"content_type": "flow"
-				}).insert(ignore_permissions=True)
-			elif message_type in ["image", "audio", "video", "document"]:
-				settings = frappe.get_doc(
-							"WhatsApp Settings", "WhatsApp Settings",
-						)
-				token = settings.get_password("token")
-				url = f"{settings.url}/{settings.version}/"
-
-
-				media_id = message[message_type]["id"]
-				headers = {
-					'Authorization': 'Bearer ' + token
-
-				}
-				response = requests.get(f'{url}{media_id}/', headers=headers)
-
-				if response.status_code == 200:
-					media_data = response.json()
-					media_url = media_data.get("url")
-					mime_type = media_data.get("mime_type")
-					file_extension = mime_type.split('/')[1]
-
-					media_response = requests.get(media_url, headers=headers)
-					if media_response.status_code == 200:
-
-						file_data = media_response.content
-						file_name = f"{frappe.generate_hash(length=10)}.{file_extension}"
-
-						message_doc = frappe.get_doc({
-							"doctype": "WhatsApp Message",
-							"type": "Incoming",
-							"from": message['from'],
-							"message_id": message['id'],
-							"reply_to_message_id": reply_to_message_id,
-							"is_reply": is_reply,
-							"message": message[message_type].get("caption",f"/files/{file_name}"),
-							"content_type" : message_type
-						}).insert(ignore_permissions=True)
-
-						file = frappe.get_doc(
-							{
-								"doctype": "File",
-								"file_name": file_name,
-								"attached_to_doctype": "WhatsApp Message",
-								"attached_to_name": message_doc.name,
-								"content": file_data,
-								"attached_to_field": "attach"
-							}
-						).save(ignore_permissions=True)
-
-
-						message_doc.attach = file.file_url
-						message_doc.save()
-			elif message_type == "button":
-				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
-					"message": message['button']['text'],
-					"message_id": message['id'],
-					"reply_to_message_id": reply_to_message_id,
-					"is_reply": is_reply,
-					"content_type": message_type
-				}).insert(ignore_permissions=True)
+def process_next_inbox_entry():
+	"""Lock and apply the oldest pending payload, returns False when inbox is empty."""
+	entry = frappe.db.sql(
+		"""SELECT name, payload FROM `tabWhatsApp Webhook Inbox`
+		WHERE status = 'Pending'
+		ORDER BY creation
+		LIMIT 1
+		FOR UPDATE SKIP LOCKED""",
+		as_dict=True
+	)
+	if not entry:
+		frappe.db.commit()
+		return False
+
+	entry = entry[0]
+	try:
+		process_payload(json.loads(entry.payload))
+		frappe.db.set_value("WhatsApp Webhook Inbox", entry.name, "status", "Processed", update_modified=False)
+	except Exception:
+		frappe.db.rollback()
+		frappe.db.set_value(
+			"WhatsApp Webhook Inbox", entry.name,
+			{"status": "Failed", "error": frappe.get_traceback()},
+			update_modified=False
+		)
+	frappe.db.commit()
+	return True
+
+def process_pending_inbox():
+	"""Pick up payloads left behind by finished workers, scheduled job."""
+	if frappe.db.exists("WhatsApp Webhook Inbox", {"status": "Pending"}):
+		enqueue_inbox_worker()
+
+def process_payload(data):
+	"""Apply every entry and change of a webhook payload."""
+	rows = []
+	statuses = []
+	for change in get_changes(data):
+		value = change.get("value") or {}
+		messages = value.get("messages", [])
+		if not messages:
+			if change.get("field") == "messages":
+				statuses += value.get("statuses", [])
 			else:
-				frappe.get_doc({
-					"doctype": "WhatsApp Message",
-					"type": "Incoming",
-					"from": message['from'],
-					"message_id": message['id'],
-					"message": message[message_type].get(message_type),
-					"content_type" : message_type
-				}).insert(ignore_permissions=True)
+				update_status(change)
+			continue
+
+		for message in messages:
+			rows.append(get_message_row(message))
+
+	# redelivered webhooks are no-ops
+	seen = get_seen_message_ids([row["message_id"] for row in rows])
+	rows = [row for row in rows if row["message_id"] not in seen]
+	inserted = insert_messages(rows)
+
+	for row in rows:
+		if row.get("media_id") and row.get("name") in inserted:
+			enqueue_media_download(row["name"], row["media_id"])
 
+	# a rolled back payload is retried, its ids must not look seen
+	message_ids = [row["message_id"] for row in rows]
+	frappe.db.after_commit.add(lambda: mark_message_ids_seen(message_ids))
+	apply_message_statuses(statuses)
+
+def get_seen_message_ids(message_ids):
+	"""Get ids already received recently, checked in redis before the database."""
+	if not message_ids:
+		return set()
+
+	cache = frappe.cache()
+	pipeline = cache.pipeline()
+	for message_id in message_ids:
+		pipeline.exists(cache.make_key(f"whatsapp_seen_message:{message_id}"))
+
+	return {message_id for message_id, exists in zip(message_ids, pipeline.execute()) if exists}
+
+def mark_message_ids_seen(message_ids):
+	"""Remember received ids for SEEN_MESSAGE_TTL seconds."""
+	if not message_ids:
+		return
+
+	cache = frappe.cache()
+	pipeline = cache.pipeline()
+	for message_id in message_ids:
+		pipeline.set(cache.make_key(f"whatsapp_seen_message:{message_id}"), 1, ex=SEEN_MESSAGE_TTL)
+	pipeline.execute()
+
+def get_changes(data):
+	"""Get all changes of all entries, batched deliveries carry several."""
+	entries = data.get("entry") or []
+	if isinstance(entries, dict):
+		entries = [entries]
+
+	for entry in entries:
+		for change in entry.get("changes") or []:
+			yield change
+
+def get_message_row(message):
+	"""Get WhatsApp Message fields for an incoming non media message."""
+	message_type = message['type']
+	is_reply = True if message.get('context') else False
+	reply_to_message_id = message['context']['id'] if is_reply else None
+	row = {
+		"type": "Incoming",
+		"from": message['from'],
+		"message_id": message['id'],
+		"reply_to_message_id": reply_to_message_id,
+		"is_reply": is_reply,
+		"content_type": message_type
+	}
+	if message_type == 'text':
+		row["message"] = message['text']['body']
+	elif message_type == 'reaction':
+		row.update({
+			"message": message['reaction']['emoji'],
+			"reply_to_message_id": message['reaction']['message_id'],
+			"is_reply": False,
+		})
+	elif message_type == 'interactive':
+		row.update({
+			"message": message['interactive']['nfm_reply']['response_json'],
+			"reply_to_message_id": None,
+			"is_reply": False,
+			"content_type": "flow"
+		})
+	elif message_type == "button":
+		row["message"] = message['button']['text']
+	elif message_type in ["image", "audio", "video", "document"]:
+		# media is downloaded in background, see enqueue_media_download
+		row.update({
+			"message": message[message_type].get("caption"),
+			"media_id": message[message_type]["id"]
+		})
 	else:
-		changes = None
+		row.update({
+			"message": message[message_type].get(message_type),
+			"reply_to_message_id": None,
+			"is_reply": False,
+		})
+	return row
+
+def insert_messages(rows):
+	"""Insert incoming messages, returns names of inserted rows.
+
+	Messages are inserted as documents so insert hooks of this and other apps
+	run, unless Bulk Insert Incoming Messages is set in WhatsApp Settings.
+	"""
+	if not rows:
+		return set()
+
+	if get_settings().bulk_insert_incoming:
+		return bulk_insert_messages(rows)
+
+	# message_id is unique, redeliveries already in the database are skipped
+	existing = get_existing_message_ids([row["message_id"] for row in rows])
+	inserted = set()
+	for row in rows:
+		if row["message_id"] in existing:
+			continue
+
+		doc = frappe.get_doc(dict(
+			{key: value for key, value in row.items() if key != "media_id"},
+			doctype="WhatsApp Message",
+			priority="Transactional"
+		))
+		frappe.db.savepoint("whatsapp_incoming_message")
 		try:
-			changes = data["entry"][0]["changes"][0]
-		except KeyError:
-			changes = data["entry"]["changes"][0]
-		update_status(changes)
-	return
+			doc.insert(ignore_permissions=True)
+		except frappe.UniqueValidationError:
+			# message_id inserted by a concurrent delivery
+			frappe.db.rollback(save_point="whatsapp_incoming_message")
+			continue
+
+		existing.add(row["message_id"])
+		row["name"] = doc.name
+		inserted.add(doc.name)
+
+	return inserted
+
+def get_existing_message_ids(message_ids):
+	return set(frappe.get_all(
+		"WhatsApp Message",
+		filters={"message_id": ("in", message_ids)},
+		pluck="message_id"
+	))
+
+def bulk_insert_messages(rows):
+	"""Insert incoming messages with a single query, skipping document hooks."""
+	now = frappe.utils.now()
+	fields = [
+		"name", "owner", "modified_by", "creation", "modified", "docstatus",
+		"type", "from", "message", "message_id", "reply_to_message_id",
+		"is_reply", "content_type", "priority"
+	]
+	for row in rows:
+		row["name"] = frappe.generate_hash(length=10)
+
+	values = [
+		(
+			row["name"], frappe.session.user, frappe.session.user,
+			now, now, 0, row["type"], row["from"], row["message"], row["message_id"],
+			row["reply_to_message_id"], int(row["is_reply"]), row["content_type"],
+			"Transactional"
+		)
+		for row in rows
+	]
+	# message_id is unique, duplicates are skipped
+	frappe.db.bulk_insert("WhatsApp Message", fields, values, ignore_duplicates=True)
+
+	# generated names are new, only rows that were inserted have them
+	inserted = set(frappe.get_all(
+		"WhatsApp Message",
+		filters={"name": ("in", [row["name"] for row in rows])},
+		pluck="name"
+	))
+	if inserted:
+		# refresh open list views once for the whole batch
+		frappe.publish_realtime(
+			"list_update",
+			{"doctype": "WhatsApp Message", "name": next(iter(inserted)), "user": frappe.session.user},
+			after_commit=True
+		)
+
+	return inserted
 
 def update_status(data):
 	"""Update status hook."""
@@ -175,16 +366,55 @@ def update_template_status(data):
 		WHERE id = %(message_template_id)s""",
 		data
 	)
+	clear_templates()
 
 def update_message_status(data):
 	"""Update message status."""
-	id = data['statuses'][0]['id']
-	status = data['statuses'][0]['status']
-	conversation = data['statuses'][0].get('conversation', {}).get('id')
-	name = frappe.db.get_value("WhatsApp Message", filters={"message_id": id})
-
-	doc = frappe.get_doc("WhatsApp Message", name)
-	doc.status = status
-	if conversation:
-		doc.conversation_id = conversation
-	doc.save(ignore_permissions=True)
\ No newline at end of file
+	apply_message_statuses(data.get('statuses', []))
+
+def apply_message_statuses(statuses):
+	"""Apply status receipts with a single UPDATE, never moving a status backwards.
+
+	Receipts can arrive out of order, a `delivered` after `read` is ignored.
+	"""
+	latest = {}
+	for status_update in statuses:
+		status = status_update['status']
+		current = latest.get(status_update['id'])
+		if current and STATUS_RANK.get(current['status'], 0) >= STATUS_RANK.get(status, 0):
+			continue
+
+		latest[status_update['id']] = {
+			"status": status,
+			"conversation": status_update.get('conversation', {}).get('id')
+		}
+
+	if not latest:
+		return
+
+	status_case, conversation_case, rank_case, values = [], [], [], []
+	for message_id, update in latest.items():
+		status_case.append("WHEN %s THEN %s")
+		values += [message_id, update["status"]]
+	for message_id, update in latest.items():
+		conversation_case.append("WHEN %s THEN COALESCE(%s, conversation_id)")
+		values += [message_id, update["conversation"]]
+	values.append(frappe.utils.now())
+	values += list(latest)
+	for message_id, update in latest.items():
+		rank_case.append("WHEN %s THEN %s")
+		values += [message_id, STATUS_RANK.get(update["status"], 0)]
+
+	current_rank = " ".join(
+		f"WHEN '{status}' THEN {rank}" for status, rank in STATUS_RANK.items()
+	)
+	frappe.db.sql(
+		f"""UPDATE `tabWhatsApp Message`
+		SET status = CASE message_id {" ".join(status_case)} END,
+			conversation_id = CASE message_id {" ".join(conversation_case)} END,
+			modified = %s
+		WHERE message_id IN ({", ".join(["%s"] * len(latest))})
+			AND (CASE status {current_rank} ELSE 0 END)
+				< (CASE message_id {" ".join(rank_case)} END)""",
+		values
+	)